@@ -0,0 +1,74 @@
+"""Commit count and wall time of POST /create against set size.
+
+    python benchmarks/commits.py [--sizes 10,50,100,500]
+
+Runs the app against a throwaway SQLite database and stub_server.py, so
+no network access is needed. Every set is made of terms nobody has
+defined yet, which is the worst case for writes.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import settings
+import stub_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10,50,100,500')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    pages = {}
+    for size in sizes:
+        for number in range(size):
+            pages['Term %d-%d' % (size, number)] = 'Definition of term %d in a set of %d.' % (number, size)
+    server, wiki = stub_server.serve({'pages': pages})
+
+    workdir = tempfile.mkdtemp()
+    settings.database_uri = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    settings.app_secret_key = 'bench'
+    settings.providers = ['stub']
+    settings.stub['api_url'] = 'http://127.0.0.1:%d/w/api.php' % server.server_port
+    settings.jobs['threshold'] = max(sizes)
+    settings.pdf_cache_dir = os.path.join(workdir, 'pdf')
+
+    from sqlalchemy import event
+    import termlio
+
+    termlio.db.create_all()
+    user = termlio.User('bench@terml.io', 'bench')
+    termlio.db.session.add(user)
+    termlio.db.session.commit()
+
+    commits = [0]
+    event.listen(termlio.db.engine, 'commit', lambda conn: commits.__setitem__(0, commits[0] + 1))
+
+    client = termlio.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+        session['user_id'] = user.id
+
+    print('%8s %8s %10s' % ('terms', 'commits', 'seconds'))
+    for size in sizes:
+        terms = '\n'.join('Term %d-%d' % (size, number) for number in range(size))
+        commits[0] = 0
+        start = time.time()
+        response = client.post('/create', data={'settitle': 'Set of %d' % size, 'terms': terms})
+        elapsed = time.time() - start
+        assert response.status_code == 200, response.status_code
+        print('%8d %8d %10.3f' % (size, commits[0], elapsed))
+
+    server.shutdown()
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
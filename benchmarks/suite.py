@@ -0,0 +1,256 @@
+"""Benchmarks for the definition and set paths at several scales.
+
+    python benchmarks/suite.py [--quick] [--delay 0.05] [--output results.json]
+                               [--compare earlier.json] [--no-memory]
+
+Drives the app through the Flask test client against a throwaway SQLite
+database, with stub_server.py standing in for Wikipedia and adding
+--delay seconds to every response. Scenarios:
+
+    create_cold     POST /create of N terms nobody has defined yet
+    create_warm     the same list again, answered from the Definition table
+    definitions     GET /definitions of that set, fragment cache cleared
+    export_pdf      GET /createpdf of that set, nothing cached on disk
+    export_quizlet  GET /quizletexport of that set
+    review          GET /review, first and last page, for a user with N sets
+    lookup          POST /create of 100 known terms with N Definition rows
+
+Each result has wall time, SQL statements executed, requests the stub
+received and, unless --no-memory, peak Python memory allocated during
+the scenario (tracemalloc, which also slows everything down). Results
+are written as JSON; --compare prints the change against an earlier run.
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import func
+
+import settings
+import stub_server
+
+SCALES = {
+    'set_sizes': [10, 100, 1000],
+    'user_sets': [1, 100, 5000],
+    'definition_rows': [1000, 100000, 1000000],
+}
+
+QUICK_SCALES = {
+    'set_sizes': [10, 100],
+    'user_sets': [1, 100],
+    'definition_rows': [1000, 10000],
+}
+
+LOOKUP_TERMS = 100
+
+
+class Meter(object):
+    """Counts SQL statements and stub requests around a scenario."""
+
+    def __init__(self, engine, wiki, memory):
+        from sqlalchemy import event
+        self.wiki = wiki
+        self.memory = memory and tracemalloc is not None
+        self.queries = 0
+        self.results = []
+        event.listen(engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.queries += 1
+
+    def measure(self, scenario, scale, run):
+        queries = self.queries
+        fetches = self.wiki.requests
+        if self.memory:
+            tracemalloc.start()
+        start = time.time()
+        run()
+        wall = time.time() - start
+        peak = None
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        result = {
+            'scenario': scenario,
+            'scale': scale,
+            'wall': round(wall, 4),
+            'queries': self.queries - queries,
+            'fetches': self.wiki.requests - fetches,
+            'peak_memory': peak,
+        }
+        self.results.append(result)
+        print('%-15s %8d %10.3f %8d %8d %10s' % (
+            scenario, scale, wall, result['queries'], result['fetches'],
+            '-' if peak is None else '%.1f MB' % (peak / 1048576.0)))
+        return result
+
+
+def signed_in_client(termlio, user):
+    client = termlio.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+        session['user_id'] = user.id
+        session['username'] = termlio.username(user.email)
+    return client
+
+
+def make_user(termlio, email):
+    user = termlio.User(email, 'bench')
+    termlio.db.session.add(user)
+    termlio.db.session.commit()
+    return user
+
+
+def check(response):
+    assert response.status_code in (200, 302), response.status_code
+    # Streamed responses only do their work as they are read.
+    return response.get_data()
+
+
+def set_scenarios(termlio, meter, sizes):
+    client = signed_in_client(termlio, make_user(termlio, 'sets@terml.io'))
+    for size in sizes:
+        terms = '\n'.join('Term %d-%d' % (size, number) for number in range(size))
+        data = {'settitle': 'Set of %d' % size, 'terms': terms}
+        termlio.definition_cache.clear()
+        meter.measure('create_cold', size, lambda: check(client.post('/create', data=data)))
+        termlio.definition_cache.clear()
+        meter.measure('create_warm', size, lambda: check(client.post('/create', data=data)))
+
+        setid = termlio.db.session.query(func.max(termlio.Set.id)).scalar()
+        termlio.db.session.remove()
+        termlio.definition_cache.clear()
+        termlio.fragment_cache.clear()
+        meter.measure('definitions', size, lambda: check(client.get('/definitions/%d' % setid)))
+        termlio.remove_exports(setid)
+        meter.measure('export_pdf', size, lambda: check(client.get('/createpdf/%d' % setid)))
+        meter.measure('export_quizlet', size, lambda: check(client.get('/quizletexport/%d' % setid)))
+
+
+def review_scenarios(termlio, meter, counts):
+    for count in counts:
+        user = make_user(termlio, 'review%d@terml.io' % count)
+        rows = [{'user_id': user.id, 'title': 'Set %d' % number, 'term_count': 10, 'version': 1}
+                for number in range(count)]
+        termlio.db.session.execute(termlio.Set.__table__.insert(), rows)
+        termlio.db.session.commit()
+        first = (termlio.db.session.query(func.min(termlio.Set.id))
+                 .filter(termlio.Set.user_id == user.id).scalar())
+        termlio.db.session.remove()
+        client = signed_in_client(termlio, user)
+
+        def run():
+            check(client.get('/review'))
+            # The page a user paging back to their oldest sets would land on.
+            check(client.get('/review?before=%d' % (first + settings.review_page_size)))
+        meter.measure('review', count, run)
+
+
+def lookup_scenarios(termlio, meter, row_counts):
+    client = signed_in_client(termlio, make_user(termlio, 'lookup@terml.io'))
+    seeded = 0
+    for rows in row_counts:
+        # Grow the table to the next size instead of reseeding it.
+        for start in range(seeded, rows, 10000):
+            batch = []
+            for number in range(start, min(start + 10000, rows)):
+                term = 'seed term %d' % number
+                batch.append({'term': term, 'term_key': term, 'definition': 'Definition of %s.' % term,
+                              'status': 'found'})
+            termlio.db.session.execute(termlio.Definition.__table__.insert(), batch)
+            termlio.db.session.commit()
+        seeded = rows
+        step = max(1, rows // LOOKUP_TERMS)
+        terms = '\n'.join('seed term %d' % number for number in range(0, rows, step)[:LOOKUP_TERMS])
+        data = {'settitle': 'Lookup in %d' % rows, 'terms': terms}
+        termlio.definition_cache.clear()
+        meter.measure('lookup', rows, lambda: check(client.post('/create', data=data)))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path) as f:
+        earlier = dict(((result['scenario'], result['scale']), result) for result in json.load(f)['results'])
+    print('\nChange in wall time against %s' % path)
+    for result in results:
+        before = earlier.get((result['scenario'], result['scale']))
+        if before and before['wall']:
+            print('%-15s %8d %+9.1f%%' % (result['scenario'], result['scale'],
+                                         (result['wall'] / before['wall'] - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true', help='only the smaller scales')
+    parser.add_argument('--delay', type=float, default=0.05, help='seconds the stub waits per request')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc')
+    args = parser.parse_args()
+    scales = QUICK_SCALES if args.quick else SCALES
+
+    pages = {}
+    for size in scales['set_sizes']:
+        for number in range(size):
+            pages['Term %d-%d' % (size, number)] = 'Definition of term %d in a set of %d.' % (number, size)
+    server, wiki = stub_server.serve({'pages': pages}, delay=args.delay)
+
+    workdir = tempfile.mkdtemp()
+    settings.database_uri = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    settings.app_secret_key = 'bench'
+    settings.providers = ['stub']
+    settings.stub['api_url'] = 'http://127.0.0.1:%d/w/api.php' % server.server_port
+    settings.jobs['threshold'] = max(scales['set_sizes'] + [LOOKUP_TERMS])
+    settings.pdf_cache_dir = os.path.join(workdir, 'pdf')
+
+    import termlio
+    termlio.db.create_all()
+    meter = Meter(termlio.db.engine, wiki, not args.no_memory)
+    started = datetime.datetime.utcnow()
+
+    print('%-15s %8s %10s %8s %8s %10s' % ('scenario', 'scale', 'seconds', 'queries', 'fetches', 'memory'))
+    try:
+        set_scenarios(termlio, meter, scales['set_sizes'])
+        review_scenarios(termlio, meter, scales['user_sets'])
+        lookup_scenarios(termlio, meter, scales['definition_rows'])
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+    report = {
+        'started': started.isoformat(),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'delay': args.delay,
+        'scales': scales,
+        'results': meter.results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        compare(meter.results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Fingerprint and precompress the files in static/ for long-lived caching.
+
+    python build_static.py [--clean]
+
+Every file is copied to settings.static_build_dir under a name that
+includes a hash of its contents, e.g. bootstrap.3f2a9c1d0e.css, with
+.gz (and, if the brotli module is installed, .br) copies of text files
+when they come out smaller. url() references between static files in
+CSS are rewritten to the new names. manifest.json maps each original
+name to its build; the app reads it at startup, so restart the web
+workers after a build. Files of earlier builds are kept, for pages that
+still refer to them, unless --clean is given.
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import settings
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# Types that are already compressed are stored as they are.
+COMPRESSIBLE = ('.css', '.js', '.map', '.svg', '.ttf', '.eot', '.json', '.txt', '.html')
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")?#]+)([^'")]*)\1\s*\)''')
+
+
+def static_files():
+    for directory, dirnames, filenames in os.walk(STATIC_DIR):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+        for filename in sorted(filenames):
+            if not filename.startswith('.'):
+                path = os.path.join(directory, filename)
+                yield os.path.relpath(path, STATIC_DIR).replace(os.sep, '/')
+
+
+def fingerprint(name, content):
+    digest = hashlib.md5(content).hexdigest()[:10]
+    base, extension = os.path.splitext(name)
+    return '%s.%s%s' % (base, digest, extension)
+
+
+def rewrite_css(name, content, built):
+    # Points url() references at the fingerprinted names of files that
+    # exist in static/; anything else is left alone.
+    def replace(match):
+        quote, url, suffix = match.groups()
+        target = os.path.normpath(os.path.join(os.path.dirname(name), url)).replace(os.sep, '/')
+        if target not in built:
+            return match.group(0)
+        relative = os.path.relpath(built[target]['path'], os.path.dirname(name) or '.').replace(os.sep, '/')
+        return 'url(%s%s%s%s)' % (quote, relative, suffix, quote)
+    return CSS_URL.sub(replace, content.decode('utf-8')).encode('utf-8')
+
+
+def gzipped(content):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buffer.getvalue()
+
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def build(build_dir):
+    built = {}
+    names = list(static_files())
+    # CSS last, so the files it refers to already have their names.
+    for name in sorted(names, key=lambda name: name.endswith('.css')):
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            content = f.read()
+        if name.endswith('.css'):
+            content = rewrite_css(name, content, built)
+        path = fingerprint(name, content)
+        encodings = []
+        write(os.path.join(build_dir, path), content)
+        if name.endswith(COMPRESSIBLE):
+            variants = [('gzip', '.gz', gzipped)]
+            if brotli is not None:
+                variants.insert(0, ('br', '.br', brotli.compress))
+            for encoding, suffix, compress in variants:
+                compressed = compress(content)
+                if len(compressed) < len(content):
+                    write(os.path.join(build_dir, path + suffix), compressed)
+                    encodings.append(encoding)
+        built[name] = {'path': path, 'encodings': encodings}
+        print('%s -> %s %s' % (name, path, ' '.join(encodings)))
+    return built
+
+
+def clean(build_dir, built):
+    keep = set(['manifest.json'])
+    for entry in built.values():
+        keep.add(entry['path'])
+        keep.update(entry['path'] + suffix for suffix in ('.gz', '.br'))
+    for directory, dirnames, filenames in os.walk(build_dir):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if os.path.relpath(path, build_dir).replace(os.sep, '/') not in keep:
+                os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fingerprint and precompress static files.')
+    parser.add_argument('--clean', action='store_true', help='remove files of earlier builds')
+    args = parser.parse_args()
+    build_dir = settings.static_build_dir
+    built = build(build_dir)
+    manifest = os.path.join(build_dir, 'manifest.json')
+    with open(manifest + '.part', 'w') as f:
+        json.dump(built, f, indent=2, sort_keys=True)
+    os.rename(manifest + '.part', manifest)
+    if args.clean:
+        clean(build_dir, built)
+    if brotli is None:
+        print('brotli is not installed; only gzip copies were written.')
+
+
+if __name__ == '__main__':
+    main()
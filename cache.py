@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def text_size(value):
+    # Rough size in characters of strings nested in tuples and lists.
+    if value is None:
+        return 0
+    if isinstance(value, (tuple, list)):
+        return sum(text_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(text_size(key) + text_size(item) for key, item in value.items())
+    return len(value) if hasattr(value, '__len__') else 8
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache with a time to live.
+
+    Bounded both by entry count and by the approximate total size of the
+    cached keys and values, as measured by sizeof.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, sizeof=text_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            value, size, expires = item
+            if expires < time.time():
+                self.size -= size
+                self.misses += 1
+                return None
+            # Re-inserting moves the key to the most recently used end.
+            self._data[key] = item
+            self.hits += 1
+            return value
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl=None):
+        size = self.sizeof(key) + self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._data[key] = (value, size, expires)
+            self.size += size
+            while len(self._data) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self._data.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self.size -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
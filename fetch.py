@@ -0,0 +1,112 @@
+import math
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+FOUND = 'found'
+MISSING = 'missing'
+AMBIGUOUS = 'ambiguous'
+UNAVAILABLE = 'unavailable'
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def fetch_all(words, fetch, workers, timeout, batch_size=1):
+    """Run fetch over batches of words on a bounded thread pool.
+
+    fetch takes a list of words and returns a (status, value) pair for
+    each of them. Results come back in the order of words. Each batch gets
+    timeout seconds per round of workers; batches that have not resolved
+    by then (or that raised) are UNAVAILABLE.
+    """
+    if not words:
+        return []
+    batches = list(chunks(words, batch_size))
+    workers = max(1, min(workers, len(batches)))
+    rounds = int(math.ceil(len(batches) / float(workers)))
+    deadline = time.time() + timeout * rounds
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = [pool.submit(fetch, batch) for batch in batches]
+    results = []
+    for batch, future in zip(batches, futures):
+        try:
+            results.extend(future.result(timeout=max(0, deadline - time.time())))
+        except TimeoutError:
+            future.cancel()
+            results.extend([(UNAVAILABLE, None)] * len(batch))
+        except Exception:
+            results.extend([(UNAVAILABLE, None)] * len(batch))
+    # Don't block the request on fetches that blew the deadline.
+    pool.shutdown(wait=False)
+    return results
+
+
+class Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+    def wait(self, timeout):
+        self.event.wait(timeout)
+        return self.result
+
+
+class SingleFlight(object):
+    """Lets concurrent callers in one process share a fetch per key."""
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def claim(self, keys):
+        # Returns the keys this caller has to fetch itself, and a Call for
+        # every key another thread is already fetching.
+        owned = []
+        waiting = {}
+        with self._lock:
+            for key in keys:
+                call = self._calls.get(key)
+                if call is None:
+                    self._calls[key] = Call()
+                    owned.append(key)
+                else:
+                    waiting[key] = call
+                    self.coalesced += 1
+        return owned, waiting
+
+    def finish(self, keys, results):
+        # Hands results (None where there is none) to every waiting caller.
+        with self._lock:
+            calls = [(self._calls.pop(key), results.get(key)) for key in keys]
+        for call, result in calls:
+            call.result = result
+            call.event.set()
+
+
+class RateLimiter(object):
+    """Token bucket that lets callers through at rate calls per second."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        # Takes a token, sleeping until it would have been refilled. The
+        # balance may go negative, which queues callers in arrival order.
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
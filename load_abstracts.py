@@ -0,0 +1,105 @@
+"""Bulk load a Wikipedia abstracts dump into the offline index.
+
+    python load_abstracts.py enwiki-latest-abstract.xml.gz [--redirects redirects.tsv]
+
+The dump is streamed (plain, .gz or .bz2) and each <doc> is discarded as
+soon as it is written, so memory use stays flat however large the dump
+is. The optional redirects file has one 'from<TAB>to' title pair per
+line. Rows go to settings.offline_index unless --index is given.
+"""
+import argparse
+import bz2
+import gzip
+import io
+import sys
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+from offline import connect, normalize_title
+import settings
+
+BATCH_SIZE = 10000
+
+
+def open_dump(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    return io.open(path, 'rb')
+
+
+def usable(abstract):
+    # Skip empty abstracts, template debris and disambiguation pages,
+    # which live Wikipedia handles better.
+    if not abstract or abstract[0] in '|{':
+        return False
+    return not abstract.rstrip(':').endswith('may refer to')
+
+
+def read_abstracts(path):
+    context = ElementTree.iterparse(open_dump(path), events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event == 'end' and element.tag == 'doc':
+            title = element.findtext('title') or ''
+            if title.startswith('Wikipedia: '):
+                title = title[len('Wikipedia: '):]
+            abstract = (element.findtext('abstract') or '').strip()
+            if title and usable(abstract):
+                yield normalize_title(title), title, abstract
+            # Drop the parsed <doc> so the tree never grows.
+            root.clear()
+
+
+def read_redirects(path):
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) == 2:
+                yield normalize_title(parts[0]), normalize_title(parts[1])
+
+
+def load(conn, sql, rows):
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            conn.executemany(sql, batch)
+            conn.commit()
+            count += len(batch)
+            batch = []
+            sys.stderr.write('\r%d rows' % count)
+    conn.executemany(sql, batch)
+    conn.commit()
+    count += len(batch)
+    sys.stderr.write('\r%d rows\n' % count)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load a Wikipedia abstracts dump into the offline index.')
+    parser.add_argument('dump')
+    parser.add_argument('--redirects')
+    parser.add_argument('--index', default=settings.offline_index)
+    args = parser.parse_args()
+    if not args.index:
+        parser.error('set settings.offline_index or pass --index')
+
+    conn = connect(args.index)
+    # A half-written index is simply reloaded, so skip the journal.
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    load(conn, 'INSERT OR REPLACE INTO abstract (key, title, abstract) VALUES (?, ?, ?)',
+         read_abstracts(args.dump))
+    if args.redirects:
+        load(conn, 'INSERT OR REPLACE INTO redirect (key, target) VALUES (?, ?)',
+             read_redirects(args.redirects))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
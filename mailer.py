@@ -0,0 +1,40 @@
+"""Sends the emails queued in the outbox by the web app.
+
+    python mailer.py [--once]
+
+Runs next to the web server like worker.py. Each batch of due messages
+goes over a single SMTP connection using settings.mail. --once sends
+whatever is due and exits. To try it locally, set settings.mail to
+localhost port 1025 without SSL and run a debugging SMTP server:
+
+    python -m smtpd -n -c DebuggingServer localhost:1025
+"""
+import argparse
+import time
+
+from termlio import app, db, claim_messages, send_messages
+import settings
+
+
+def work(once=False):
+    with app.app_context():
+        while True:
+            messages = claim_messages()
+            if messages:
+                send_messages(messages)
+            db.session.remove()
+            if not messages:
+                if once:
+                    break
+                time.sleep(settings.outbox['poll_interval'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send queued email.')
+    parser.add_argument('--once', action='store_true', help='send what is due, then exit')
+    args = parser.parse_args()
+    work(args.once)
+
+
+if __name__ == '__main__':
+    main()
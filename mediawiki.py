@@ -0,0 +1,121 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+from fetch import FOUND, MISSING, AMBIGUOUS
+
+# The API accepts at most 50 titles per query for regular clients.
+BATCH_SIZE = 50
+
+
+class MediaWikiClient(object):
+    """Batch client for the MediaWiki extracts API.
+
+    One keep-alive session is shared by every thread, so a chunk of up to
+    BATCH_SIZE titles costs a single round trip (plus continuations).
+    With a limiter (see fetch.RateLimiter), every HTTP request waits for
+    it first.
+    """
+
+    def __init__(self, api_url, sentences=2, pool_size=10, timeout=None, limiter=None):
+        self.api_url = api_url
+        self.sentences = sentences
+        self.timeout = timeout
+        self.limiter = limiter
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'Terml.io (support@terml.io)'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def query(self, params):
+        # Yields the 'query' part of every response, following continuations.
+        params = dict(params)
+        params.update({'action': 'query', 'format': 'json', 'continue': ''})
+        while True:
+            if self.limiter is not None:
+                self.limiter.wait()
+            response = self.session.get(self.api_url, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+            if 'error' in data:
+                raise requests.RequestException(data['error'].get('info', 'MediaWiki API error'))
+            yield data.get('query', {})
+            if 'continue' not in data:
+                break
+            params.update(data['continue'])
+
+    def extracts(self, titles):
+        """Resolve titles to (status, value) pairs, keyed by the given title."""
+        targets = {}
+        pages = {}
+        for query in self.query({
+            'prop': 'extracts|pageprops',
+            'exintro': 1,
+            'explaintext': 1,
+            'exsentences': self.sentences,
+            'exlimit': 'max',
+            'ppprop': 'disambiguation',
+            'redirects': 1,
+            'titles': '|'.join(titles),
+        }):
+            for item in query.get('normalized', []) + query.get('redirects', []):
+                targets[item['from']] = item['to']
+            for page in query.get('pages', {}).values():
+                pages.setdefault(page['title'], {}).update(page)
+
+        results = {}
+        ambiguous = {}
+        for title in titles:
+            page = pages.get(resolve_title(title, targets))
+            if page is None or 'missing' in page or 'invalid' in page:
+                results[title] = (MISSING, None)
+            elif 'disambiguation' in page.get('pageprops', {}):
+                ambiguous[title] = page['title']
+            elif page.get('extract'):
+                results[title] = (FOUND, page['extract'].strip())
+            else:
+                results[title] = (MISSING, None)
+
+        if ambiguous:
+            links = self.links(list(set(ambiguous.values())))
+            for title, page_title in ambiguous.items():
+                results[title] = (AMBIGUOUS, links.get(page_title, []))
+        return results
+
+    def search(self, text):
+        """Best title for text: the spelling suggestion, else the top hit."""
+        for query in self.query({
+            'list': 'search',
+            'srsearch': text,
+            'srlimit': 1,
+            'srinfo': 'suggestion',
+            'srprop': '',
+        }):
+            suggestion = query.get('searchinfo', {}).get('suggestion')
+            if suggestion:
+                return suggestion
+            hits = query.get('search', [])
+            return hits[0]['title'] if hits else None
+
+    def links(self, titles):
+        """Article links on each page, used as disambiguation options."""
+        links = {}
+        for query in self.query({
+            'prop': 'links',
+            'plnamespace': 0,
+            'pllimit': 'max',
+            'titles': '|'.join(titles),
+        }):
+            for page in query.get('pages', {}).values():
+                options = links.setdefault(page['title'], [])
+                options.extend(link['title'] for link in page.get('links', []))
+        return links
+
+
+def resolve_title(title, targets):
+    # Follows normalization and redirects, guarding against loops.
+    seen = set()
+    while title in targets and title not in seen:
+        seen.add(title)
+        title = targets[title]
+    return title
@@ -0,0 +1,155 @@
+"""Counters and histograms exported in the Prometheus text format.
+
+Every process keeps its own values in memory. With a directory
+configured, each one also saves them to metrics-<pid>.json there every
+flush_interval seconds, and render() sums the files of all processes,
+so any gunicorn worker can answer a scrape for the whole server. Files
+of processes that have exited are kept, so totals never go backwards;
+empty the directory when the server is restarted.
+"""
+import glob
+import json
+import os
+import threading
+import time
+
+# Upper bounds, in seconds, of the default histogram buckets.
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"')
+                                                 .replace('\n', '\\n'))
+                             for key, value in pairs)
+
+
+def format_bound(bound):
+    return '+Inf' if bound is None else repr(float(bound))
+
+
+class Metrics(object):
+
+    def __init__(self, directory=None, flush_interval=5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.counters = {}
+        self.histograms = {}
+        self.buckets = {}
+        self.help = {}
+        self.collectors = []
+        self.flushed = 0
+        self._lock = threading.Lock()
+
+    def describe(self, name, text, buckets=None):
+        self.help[name] = text
+        if buckets is not None:
+            self.buckets[name] = tuple(buckets)
+
+    def register(self, collector):
+        # collector() returns (name, labels, total) for counters kept
+        # elsewhere, such as a provider's call count; read on every flush.
+        self.collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self.buckets.get(name, TIME_BUCKETS)
+        key = (name, label_key(labels))
+        with self._lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum.
+                counts = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            for number, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[number] += 1
+                    break
+            else:
+                counts[len(buckets)] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        counters = []
+        for collector in self.collectors:
+            for name, labels, total in collector():
+                counters.append([name, list(label_key(labels)), total])
+        with self._lock:
+            counters.extend([name, list(labels), value] for (name, labels), value in self.counters.items())
+            histograms = [[name, list(labels), list(self.buckets.get(name, TIME_BUCKETS)), list(counts)]
+                          for (name, labels), counts in self.histograms.items()]
+        return {'counters': counters, 'histograms': histograms}
+
+    def maybe_flush(self):
+        if self.directory and time.time() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.directory:
+            return
+        self.flushed = time.time()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, 'metrics-%d.json' % os.getpid())
+        with open(path + '.part', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.rename(path + '.part', path)
+
+    def snapshots(self):
+        if not self.directory:
+            return [self.snapshot()]
+        self.flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, OSError, ValueError):
+                # Removed or half written by its process; next scrape.
+                pass
+        return snapshots
+
+    def render(self):
+        """All processes' metrics, summed, in the Prometheus text format."""
+        counters = {}
+        histograms = {}
+        for snapshot in self.snapshots():
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, counts in snapshot['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels), tuple(buckets))
+                total = histograms.setdefault(key, [0] * len(counts))
+                for number, count in enumerate(counts):
+                    total[number] += count
+
+        lines = []
+        for name in sorted(set(name for name, labels in counters)):
+            lines.append('# HELP %s %s' % (name, self.help.get(name, name)))
+            lines.append('# TYPE %s counter' % name)
+            for (other, labels), value in sorted(counters.items()):
+                if other == name:
+                    lines.append('%s%s %s' % (name, format_labels(labels), repr(value)))
+        for name in sorted(set(name for name, labels, buckets in histograms)):
+            lines.append('# HELP %s %s' % (name, self.help.get(name, name)))
+            lines.append('# TYPE %s histogram' % name)
+            for (other, labels, buckets), counts in sorted(histograms.items()):
+                if other != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + [None], counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', format_bound(bound))]),
+                                                     cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), repr(counts[-1])))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
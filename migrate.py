@@ -0,0 +1,186 @@
+"""Bring an existing Terml.io database up to date with the models.
+
+New databases only need db.create_all(). Databases created before a
+schema change need `python migrate.py`, which applies each step below in
+order and records it in the schema_migration table so it runs once.
+"""
+import binascii
+import datetime
+import os
+
+from sqlalchemy import column, func, inspect, select, table, text
+
+from termlio import db, normalize_term, Definition, Set, SetTerm, User
+
+BATCH_SIZE = 10000
+
+
+def columns(conn, table):
+    return [column['name'] for column in inspect(conn).get_columns(table)]
+
+
+def indexes(conn, table):
+    return [index['name'] for index in inspect(conn).get_indexes(table)]
+
+
+def add_column(conn, model_column):
+    # Adds a model column to its existing table, typed for this database.
+    # Names are quoted, since 'set' and 'user' are reserved words.
+    if model_column.name not in columns(conn, model_column.table.name):
+        preparer = conn.dialect.identifier_preparer
+        conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (
+            preparer.format_table(model_column.table), preparer.format_column(model_column),
+            model_column.type.compile(dialect=conn.dialect))))
+
+
+def create_index(conn, model_table, name):
+    # Creates one of the model's indexes if the table does not have it yet.
+    if name not in indexes(conn, model_table.name):
+        for index in model_table.indexes:
+            if index.name == name:
+                index.create(conn)
+
+
+def definition_term_key(conn):
+    # Normalized, uniquely indexed lookup key for Definition.
+    add_column(conn, Definition.__table__.c.term_key)
+
+    # Backfill in primary key order so memory stays flat on large tables.
+    update = text('UPDATE definition SET term_key = :term_key WHERE id = :row_id')
+    last_id = 0
+    while True:
+        rows = conn.execute(text('SELECT id, term FROM definition '
+                                 'WHERE id > :last_id ORDER BY id LIMIT :limit'),
+                            last_id=last_id, limit=BATCH_SIZE).fetchall()
+        if not rows:
+            break
+        conn.execute(update, [{'row_id': row_id, 'term_key': normalize_term(term or '')}
+                              for row_id, term in rows])
+        last_id = rows[-1][0]
+
+    # Keep the oldest row for every key. The derived table lets MySQL
+    # delete from the table it is selecting from.
+    conn.execute(text('DELETE FROM definition WHERE id NOT IN '
+                      '(SELECT id FROM (SELECT MIN(id) AS id FROM definition '
+                      'GROUP BY term_key) AS keep)'))
+    create_index(conn, Definition.__table__, 'ix_definition_term_key')
+
+
+def definition_status(conn):
+    # Negative cache entries: 'missing' pages and disambiguation options.
+    for name in ('status', 'options', 'expires_at'):
+        add_column(conn, Definition.__table__.c[name])
+    conn.execute(text("UPDATE definition SET status = 'found' WHERE status IS NULL"))
+
+
+def set_terms(conn):
+    # Moves the '>><<'-joined Set.terms text into SetTerm rows linked to
+    # their Definition. The old column is left in place but unused.
+    if 'terms' not in columns(conn, 'set'):
+        return
+    old_sets = table('set', column('id'), column('terms'))
+    insert = SetTerm.__table__.insert()
+    last_id = 0
+    while True:
+        sets = conn.execute(select([old_sets.c.id, old_sets.c.terms])
+                            .where(old_sets.c.id > last_id)
+                            .order_by(old_sets.c.id)
+                            .limit(500)).fetchall()
+        if not sets:
+            break
+        last_id = sets[-1][0]
+        words = dict((set_id, [term for term in (terms or '').split('>><<') if term != ''])
+                     for set_id, terms in sets)
+        keys = list(set(normalize_term(word) for group in words.values() for word in group))
+        ids = {}
+        for start in range(0, len(keys), 500):
+            query = (select([Definition.id, Definition.term_key])
+                     .where(Definition.term_key.in_(keys[start:start + 500])))
+            ids.update((term_key, definition_id) for definition_id, term_key in conn.execute(query))
+        rows = []
+        for set_id, group in words.items():
+            for position, word in enumerate(group):
+                rows.append({'set_id': set_id, 'position': position, 'term': word,
+                             'definition_id': ids.get(normalize_term(word))})
+        if rows:
+            conn.execute(insert, rows)
+
+
+def set_term_count(conn):
+    # Stored term counts and a (user_id, id) index for paging /review.
+    add_column(conn, Set.__table__.c.term_count)
+    count = (select([func.count(SetTerm.id)])
+             .where(SetTerm.set_id == Set.id)
+             .as_scalar())
+    conn.execute(Set.__table__.update().values(term_count=count))
+    create_index(conn, Set.__table__, 'ix_set_user_id_id')
+
+
+def set_version(conn):
+    add_column(conn, Set.__table__.c.version)
+    conn.execute(Set.__table__.update().where(Set.version == None).values(version=1))
+
+
+def set_updated_at(conn):
+    add_column(conn, Set.__table__.c.updated_at)
+    conn.execute(Set.__table__.update().where(Set.updated_at == None)
+                 .values(updated_at=datetime.datetime.utcnow()))
+
+
+def set_token(conn):
+    # Random token telling a set apart from earlier sets with the same id.
+    add_column(conn, Set.__table__.c.token)
+    last_id = 0
+    while True:
+        ids = [row_id for row_id, in conn.execute(select([Set.id])
+                                                  .where(Set.id > last_id)
+                                                  .order_by(Set.id)
+                                                  .limit(BATCH_SIZE))]
+        if not ids:
+            break
+        conn.execute(text('UPDATE %s SET token = :token WHERE id = :row_id'
+                          % conn.dialect.identifier_preparer.format_table(Set.__table__)),
+                     [{'row_id': row_id, 'token': binascii.hexlify(os.urandom(8)).decode('ascii')}
+                      for row_id in ids])
+        last_id = ids[-1]
+
+
+def user_api_token(conn):
+    add_column(conn, User.__table__.c.api_token_hash)
+    create_index(conn, User.__table__, 'ix_user_api_token_hash')
+
+
+MIGRATIONS = [
+    definition_term_key,
+    definition_status,
+    set_terms,
+    set_term_count,
+    set_version,
+    set_updated_at,
+    user_api_token,
+    set_token,
+]
+
+
+def applied(conn):
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_migration '
+                      '(name VARCHAR(100) PRIMARY KEY)'))
+    return set(row[0] for row in conn.execute(text('SELECT name FROM schema_migration')))
+
+
+def migrate():
+    db.create_all()
+    with db.engine.begin() as conn:
+        done = applied(conn)
+    for migration in MIGRATIONS:
+        if migration.__name__ in done:
+            continue
+        print('Applying %s' % migration.__name__)
+        with db.engine.begin() as conn:
+            migration(conn)
+            conn.execute(text('INSERT INTO schema_migration (name) VALUES (:name)'),
+                         name=migration.__name__)
+
+
+if __name__ == '__main__':
+    migrate()
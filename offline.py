@@ -0,0 +1,64 @@
+"""Local index of Wikipedia abstracts, consulted before live Wikipedia.
+
+The index is a SQLite file built by load_abstracts.py from a Wikipedia
+abstracts dump (enwiki-latest-abstract.xml). Lookups are primary key
+reads on a normalized title, so they take microseconds and need no
+network access.
+"""
+import sqlite3
+import threading
+
+from fetch import FOUND
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS abstract (key TEXT PRIMARY KEY, title TEXT, abstract TEXT);
+CREATE TABLE IF NOT EXISTS redirect (key TEXT PRIMARY KEY, target TEXT);
+"""
+
+
+def normalize_title(title):
+    # Matches 'Photosynthesis', 'photosynthesis' and 'Photo_synthesis '-style
+    # variants of the same title.
+    return ' '.join(title.replace('_', ' ').split()).lower()
+
+
+def connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class AbstractIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self):
+        # sqlite3 connections are not shared between threads.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = connect(self.path)
+        return conn
+
+    def lookup(self, words):
+        """Map the words found in the index to (FOUND, abstract) pairs.
+
+        Words that are not in the index are left out so the caller can
+        fall back to live Wikipedia.
+        """
+        conn = self.connection()
+        results = {}
+        for word in words:
+            key = normalize_title(word)
+            # Follow at most a couple of redirect hops.
+            for _ in range(3):
+                row = conn.execute('SELECT abstract FROM abstract WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    results[word] = (FOUND, row[0])
+                    break
+                row = conn.execute('SELECT target FROM redirect WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    break
+                key = row[0]
+        return results
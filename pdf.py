@@ -0,0 +1,124 @@
+"""Minimal streaming PDF writer for exporting sets.
+
+Only the standard Helvetica fonts are used, so no font files are
+embedded. Pages are emitted as soon as they are laid out and only byte
+offsets are kept for the cross-reference table, so memory use does not
+grow with the size of the set.
+"""
+
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+MARGIN = 54
+
+# Helvetica advance widths for ASCII 32-126, in 1/1000 em.
+WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+
+REGULAR = ('F1', 1.0)
+# Bold glyphs are wider; scaling the regular widths keeps lines inside the margin.
+BOLD = ('F2', 1.1)
+
+
+def text_width(text, size, font=REGULAR):
+    width = 0
+    for char in text:
+        code = ord(char)
+        width += WIDTHS[code - 32] if 32 <= code <= 126 else 556
+    return width * size * font[1] / 1000.0
+
+
+def wrap(text, size, width, font=REGULAR):
+    lines = []
+    line = ''
+    for word in text.split():
+        candidate = word if not line else line + ' ' + word
+        if line and text_width(candidate, size, font) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    if line:
+        lines.append(line)
+    return lines or ['']
+
+
+def escape(text):
+    # WinAnsiEncoding is close enough to cp1252 for text strings.
+    text = text.encode('cp1252', 'replace').decode('cp1252')
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def blocks(title, entries, width):
+    # Yields (text, size, font, leading) for every line; text is None for spacing.
+    for text in wrap(title, 18, width, BOLD):
+        yield text, 18, BOLD, 24
+    for term, definition in entries:
+        yield None, 0, None, 8
+        for text in wrap(term, 12, width, BOLD):
+            yield text, 12, BOLD, 16
+        for text in wrap(definition or '', 11, width):
+            yield text, 11, REGULAR, 14
+
+
+def layout(title, entries):
+    # Yields the text operators of each page in turn.
+    ops = []
+    y = PAGE_HEIGHT - MARGIN
+    for text, size, font, leading in blocks(title, entries, PAGE_WIDTH - 2 * MARGIN):
+        if y - leading < MARGIN:
+            yield ops
+            ops = []
+            y = PAGE_HEIGHT - MARGIN
+        y -= leading
+        if text is not None:
+            ops.append('BT /%s %d Tf %d %.2f Td (%s) Tj ET' % (font[0], size, MARGIN, y, escape(text)))
+    yield ops
+
+
+def render_pdf(title, entries):
+    """Yield a PDF document in chunks for (term, definition) pairs."""
+    offsets = {}
+    position = [0]
+
+    def emit(number, body):
+        offsets[number] = position[0]
+        chunk = ('%d 0 obj\n' % number).encode('latin-1') + body + b'\nendobj\n'
+        position[0] += len(chunk)
+        return chunk
+
+    header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    position[0] = len(header)
+    yield header
+    # Objects 1-4 are fixed; the page tree (2) is written last, once the
+    # number of pages is known.
+    yield emit(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    yield emit(3, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+    yield emit(4, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>')
+
+    pages = []
+    number = 5
+    for ops in layout(title, entries):
+        content = '\n'.join(ops).encode('cp1252')
+        yield emit(number, ('<< /Length %d >>\nstream\n' % len(content)).encode('latin-1') +
+                   content + b'\nendstream')
+        yield emit(number + 1, ('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] '
+                                '/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> '
+                                '/Contents %d 0 R >>' % (PAGE_WIDTH, PAGE_HEIGHT, number)).encode('latin-1'))
+        pages.append(number + 1)
+        number += 2
+
+    kids = ' '.join('%d 0 R' % page for page in pages)
+    yield emit(2, ('<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(pages))).encode('latin-1'))
+
+    xref = position[0]
+    lines = ['xref', '0 %d' % number, '0000000000 65535 f ']
+    for obj in range(1, number):
+        lines.append('%010d 00000 n ' % offsets[obj])
+    lines.append('trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (number, xref))
+    yield '\n'.join(lines).encode('latin-1')
@@ -0,0 +1,176 @@
+"""Definition providers, tried in order by fetch_definitions().
+
+Every provider call goes through a circuit breaker and optional retries.
+After repeated failures the breaker opens, and lookups fail fast as
+'unavailable' instead of tying up web workers. Each provider keeps call,
+error and latency counters for monitoring.
+"""
+import random
+import threading
+import time
+
+from fetch import MISSING, UNAVAILABLE
+from mediawiki import MediaWikiClient
+from offline import AbstractIndex
+
+
+class CircuitBreaker(object):
+    """Opens after `failures` consecutive errors; after `reset_after`
+    seconds one trial call is let through to close it again."""
+
+    def __init__(self, failures, reset_after):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.consecutive = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_after:
+                # Half open: let this call through, and re-arm the timer
+                # so concurrent callers keep failing fast meanwhile.
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.consecutive = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            if self.consecutive >= self.failures:
+                self.opened_at = time.time()
+
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class Provider(object):
+    name = None
+    batch_size = 50
+    # Remote providers are called from the fetch thread pool.
+    remote = True
+
+    def __init__(self, breaker, retries=0, retry_backoff=0.5):
+        self.breaker = breaker
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.calls = 0
+        self.errors = 0
+        self.short_circuits = 0
+        self.latency = 0.0
+        self._lock = threading.Lock()
+
+    def fetch(self, words):
+        """Return {word: (status, value)} for the words this provider answers."""
+        raise NotImplementedError
+
+    def lookup(self, words):
+        # fetch() behind the breaker, with jittered exponential backoff
+        # between retries. Returns one (status, value) pair per word,
+        # UNAVAILABLE for words left unanswered.
+        results = {}
+        if not self.breaker.allow():
+            self.count(short_circuits=1)
+        else:
+            for attempt in range(self.retries + 1):
+                start = time.time()
+                try:
+                    results = self.fetch(words)
+                except Exception:
+                    self.count(calls=1, errors=1, latency=time.time() - start)
+                    if attempt == self.retries:
+                        self.breaker.failure()
+                    else:
+                        time.sleep(self.retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+                    continue
+                self.count(calls=1, latency=time.time() - start)
+                self.breaker.success()
+                break
+        return [results.get(word, (UNAVAILABLE, None)) for word in words]
+
+    def count(self, calls=0, errors=0, short_circuits=0, latency=0.0):
+        with self._lock:
+            self.calls += calls
+            self.errors += errors
+            self.short_circuits += short_circuits
+            self.latency += latency
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'short_circuits': self.short_circuits,
+                'latency': self.latency,
+                'circuit_open': self.breaker.is_open(),
+            }
+
+
+class OfflineProvider(Provider):
+    name = 'offline'
+    batch_size = 500
+    remote = False
+
+    def __init__(self, path, breaker):
+        Provider.__init__(self, breaker)
+        self.index = AbstractIndex(path)
+
+    def fetch(self, words):
+        return self.index.lookup(words)
+
+
+class WikipediaProvider(Provider):
+    name = 'wikipedia'
+
+    def __init__(self, config, breaker, pool_size):
+        Provider.__init__(self, breaker, config['retries'], config['retry_backoff'])
+        self.batch_size = config['batch_size']
+        self.client = MediaWikiClient(config['api_url'], sentences=2, pool_size=pool_size,
+                                      timeout=(config['connect_timeout'], config['read_timeout']))
+
+    def fetch(self, words):
+        results = self.client.extracts(words)
+        # Terms with no exact title get the search suggestion, like the
+        # auto-suggest the 'wikipedia' package used to do.
+        suggestions = {}
+        for word in words:
+            if results[word][0] == MISSING:
+                title = self.client.search(word)
+                if title:
+                    suggestions[word] = title
+        if suggestions:
+            found = self.client.extracts(list(set(suggestions.values())))
+            for word, title in suggestions.items():
+                results[word] = found[title]
+        return results
+
+
+class StubProvider(WikipediaProvider):
+    # Same client, pointed at stub_server.py for local testing.
+    name = 'stub'
+
+
+def build_providers(settings):
+    """Instantiate the providers named in settings.providers, in order."""
+    providers = []
+    for name in settings.providers:
+        breaker = CircuitBreaker(settings.circuit_breaker['failures'],
+                                 settings.circuit_breaker['reset_after'])
+        if name == 'offline':
+            if settings.offline_index:
+                providers.append(OfflineProvider(settings.offline_index, breaker))
+        elif name == 'wikipedia':
+            providers.append(WikipediaProvider(settings.wikipedia, breaker, settings.fetch['workers']))
+        elif name == 'stub':
+            config = dict(settings.wikipedia, api_url=settings.stub['api_url'])
+            providers.append(StubProvider(config, breaker, settings.fetch['workers']))
+        else:
+            raise ValueError('Unknown definition provider %r' % name)
+    return providers
@@ -0,0 +1,99 @@
+"""Server-side sessions kept in the database.
+
+Only a random session id travels in the cookie; the session itself is
+stored as compact JSON in a table and expires after idle_timeout seconds
+without a request.
+"""
+import binascii
+import datetime
+import json
+import os
+import random
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+def new_session_id():
+    return binascii.hexlify(os.urandom(20)).decode('ascii')
+
+
+class ServerSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Moves the session to a new id, so an id handed out before
+        sign-in can't be used to ride along afterwards."""
+        if not self.new:
+            self.replaced_sid = self.sid
+        self.sid = new_session_id()
+        self.new = True
+        self.modified = True
+
+
+class SqlSessionInterface(SessionInterface):
+    """Stores sessions as rows of model, which needs id (String), data
+    (Text) and expires_at (DateTime) columns."""
+
+    def __init__(self, db, model, idle_timeout):
+        self.db = db
+        self.table = model.__table__
+        self.idle_timeout = datetime.timedelta(seconds=idle_timeout)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            with self.db.engine.connect() as conn:
+                row = conn.execute(self.table.select().where(self.table.c.id == sid)).first()
+            if row is not None and row.expires_at > datetime.datetime.utcnow():
+                session = ServerSession(json.loads(row.data), sid=sid)
+                session.expires_at = row.expires_at
+                return session
+        return ServerSession(sid=new_session_id(), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.replaced_sid is not None:
+            with self.db.engine.begin() as conn:
+                conn.execute(self.table.delete().where(self.table.c.id == session.replaced_sid))
+            if not session:
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+                return
+        if not session:
+            # Emptied (signed out) or never used: nothing to keep.
+            if not session.new:
+                with self.db.engine.begin() as conn:
+                    conn.execute(self.table.delete().where(self.table.c.id == session.sid))
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        now = datetime.datetime.utcnow()
+        expires_at = now + self.idle_timeout
+        # Unchanged sessions are written at most once per half idle window
+        # just to push their expiry back.
+        touch = not session.new and session.expires_at - now < self.idle_timeout / 2
+        if session.new or session.modified or touch:
+            data = json.dumps(dict(session), separators=(',', ':'))
+            with self.db.engine.begin() as conn:
+                if session.new:
+                    conn.execute(self.table.insert().values(id=session.sid, data=data, expires_at=expires_at))
+                    if random.random() < 0.01:
+                        conn.execute(self.table.delete().where(self.table.c.expires_at < now))
+                else:
+                    conn.execute(self.table.update()
+                                 .where(self.table.c.id == session.sid)
+                                 .values(data=data, expires_at=expires_at))
+        if session.new:
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                secure=self.get_cookie_secure(app),
+                                domain=domain, path=path)
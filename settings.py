@@ -1,3 +1,5 @@
+import os
+
 app_secret_key = ''
 
 database_uri = ''
@@ -9,3 +11,126 @@ mail = {
     'username':'',
     'password':''
 }
+
+# Outgoing email is queued in the database and sent by mailer.py, up to
+# batch_size messages per SMTP connection. Failed sends are retried after
+# retry_backoff seconds, doubling each time, until max_attempts. lease is
+# how long a claimed message is left to one mailer.
+outbox = {
+    'batch_size': 50,
+    'poll_interval': 5,
+    'lease': 300,
+    'max_attempts': 5,
+    'retry_backoff': 60
+}
+
+# Concurrent definition fetching: worker threads per request and
+# seconds allowed per batch before giving up on it. lease is how long
+# other web workers wait on a term this worker is fetching before
+# assuming it died.
+fetch = {
+    'workers': 8,
+    'timeout': 30,
+    'lease': 60
+}
+
+# Definition providers, tried in order until one answers a term.
+# 'offline' needs offline_index below; 'stub' talks to stub_server.py.
+providers = ['offline', 'wikipedia']
+
+# MediaWiki API used for batched definition lookups. Timeouts are in
+# seconds; failed calls are retried with jittered exponential backoff.
+wikipedia = {
+    'api_url': 'https://en.wikipedia.org/w/api.php',
+    'batch_size': 50,
+    'connect_timeout': 3.05,
+    'read_timeout': 10,
+    'retries': 2,
+    'retry_backoff': 0.5
+}
+
+stub = {
+    'api_url': 'http://127.0.0.1:8001/w/api.php'
+}
+
+# After this many consecutive failures a provider is skipped, and its
+# terms reported unavailable, for reset_after seconds.
+circuit_breaker = {
+    'failures': 5,
+    'reset_after': 30
+}
+
+# In-process definition cache, per web worker. ttl is in seconds;
+# negative_ttl is how long 'no page' and disambiguation results are kept,
+# both in memory and in the Definition table.
+definition_cache = {
+    'max_entries': 50000,
+    'max_bytes': 64 * 1024 * 1024,
+    'ttl': 24 * 60 * 60,
+    'negative_ttl': 7 * 24 * 60 * 60
+}
+
+# Sessions are stored server-side and dropped after idle_timeout seconds
+# without a request.
+session = {
+    'idle_timeout': 14 * 24 * 60 * 60
+}
+
+# Rendered term lists of sets, per web worker; ttl is in seconds.
+fragment_cache = {
+    'max_entries': 1000,
+    'max_bytes': 32 * 1024 * 1024,
+    'ttl': 24 * 60 * 60
+}
+
+# Prometheus metrics on /metrics, served only to scrapers sending
+# 'Authorization: Bearer <token>' from allowed_ips; with no token set the
+# page is off. Behind a reverse proxy every request comes from the
+# proxy's address, so allowed_ips is no protection there on its own.
+# With several gunicorn workers, set directory to a path they all share
+# and empty it on restart; each worker saves its numbers there every
+# flush_interval seconds. Requests taking slow_request seconds or more
+# are written to slow_request_log, if set, with their spans and query
+# counts.
+metrics = {
+    'directory': None,
+    'flush_interval': 5,
+    'token': None,
+    'allowed_ips': ['127.0.0.1'],
+    'slow_request': 2.0,
+    'slow_request_log': None
+}
+
+# Limits per call of the JSON API (/api/definitions and /api/sets).
+api = {
+    'max_terms': 1000,
+    'max_sets': 100
+}
+
+# Sets shown per page on /review.
+review_page_size = 50
+
+# Generated PDF exports, one file per set version.
+pdf_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'pdf')
+
+# Output of build_static.py: fingerprinted, precompressed static files
+# served from /assets/ with long-lived cache headers.
+static_build_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build', 'static')
+
+# Sets with more terms than this get a file download on the Quizlet page
+# instead of an inline import text area.
+quizlet_inline_limit = 200
+
+# Background set creation. Lists with more than threshold terms are
+# queued for worker.py. lease is how many seconds a running job may go
+# without a heartbeat before another worker takes it over.
+jobs = {
+    'threshold': 100,
+    'poll_interval': 2,
+    'lease': 300,
+    'max_attempts': 3
+}
+
+# SQLite file built by load_abstracts.py. When set, definitions are looked
+# up there first and live Wikipedia is only a fallback.
+offline_index = None
@@ -0,0 +1,131 @@
+"""Local stand-in for the MediaWiki API, for tests and benchmarks.
+
+    python stub_server.py fixture.json [--port 8001] [--delay 0.2]
+
+Point the 'stub' provider (settings.stub['api_url']) at it. The fixture
+is a JSON object with three optional keys:
+
+    {"pages": {"Photosynthesis": "Photosynthesis is ..."},
+     "disambiguation": {"Mercury": ["Mercury (planet)", "Mercury (element)"]},
+     "redirects": {"Photo synthesis": "Photosynthesis"}}
+
+It answers the queries MediaWikiClient makes (extracts, pageprops,
+links and search), and --delay adds latency to every response.
+"""
+import argparse
+import json
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+
+class StubWiki(object):
+
+    def __init__(self, fixture):
+        self.pages = fixture.get('pages', {})
+        self.disambiguation = fixture.get('disambiguation', {})
+        self.redirects = fixture.get('redirects', {})
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def query(self, params):
+        if params.get('list') == 'search':
+            return self.search(params.get('srsearch', ''))
+        titles = [title for title in params.get('titles', '').split('|') if title]
+        query = {'normalized': [], 'redirects': [], 'pages': {}}
+        for number, title in enumerate(titles):
+            normalized = title[:1].upper() + title[1:].replace('_', ' ')
+            if normalized != title:
+                query['normalized'].append({'from': title, 'to': normalized})
+            if normalized in self.redirects and 'redirects' in params:
+                query['redirects'].append({'from': normalized, 'to': self.redirects[normalized]})
+                normalized = self.redirects[normalized]
+            query['pages'][str(number + 1)] = self.page(normalized, params.get('prop', ''))
+        return {'query': query}
+
+    def page(self, title, prop):
+        if title in self.disambiguation:
+            page = {'title': title, 'pageprops': {'disambiguation': ''}}
+            if 'links' in prop:
+                page['links'] = [{'title': option} for option in self.disambiguation[title]]
+            return page
+        if title in self.pages:
+            page = {'title': title}
+            if 'extracts' in prop:
+                page['extract'] = self.pages[title]
+            return page
+        return {'title': title, 'missing': ''}
+
+    def search(self, text):
+        text = text.lower()
+        hits = [{'title': title} for title in sorted(self.pages) if text in title.lower()]
+        return {'query': {'searchinfo': {}, 'search': hits[:1]}}
+
+
+def make_handler(wiki, delay):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            wiki.count()
+            if delay:
+                time.sleep(delay)
+            params = dict((key, values[0]) for key, values in parse_qs(urlparse(self.path).query).items())
+            body = json.dumps(wiki.query(params)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(fixture, port=0, delay=0):
+    """Start the stub in a background thread; returns (server, wiki).
+
+    The port actually bound is server.server_port.
+    """
+    wiki = StubWiki(fixture)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(wiki, delay))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, wiki
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a stub MediaWiki API from a JSON fixture.')
+    parser.add_argument('fixture')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--delay', type=float, default=0)
+    args = parser.parse_args()
+    with open(args.fixture) as f:
+        fixture = json.load(f)
+    wiki = StubWiki(fixture)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(wiki, args.delay))
+    print('Stub MediaWiki API on http://127.0.0.1:%d/w/api.php' % args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
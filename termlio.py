@@ -1,19 +1,44 @@
+import binascii
 import datetime
+import glob
+import hashlib
+import hmac
+import json
+import logging
+import mimetypes
+import os
 import re
 import random
+import smtplib
+import socket
+import time
+from contextlib import contextmanager
 
-from flask import Flask, request, session, redirect, render_template
+from flask import Flask, abort, g, has_request_context, request, session, redirect, render_template, flash, jsonify, make_response, url_for, Markup, Response, safe_join, send_file, stream_with_context
 from flask.ext.mail import Message, Mail
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, or_
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from wtforms import validators
 
+from cache import LRUCache
+from fetch import chunks, fetch_all, SingleFlight, FOUND, MISSING, AMBIGUOUS, UNAVAILABLE
 from forms import SignUpForm
+from metrics import Metrics
+from pdf import render_pdf
+from providers import build_providers
+from sessions import SqlSessionInterface
 import settings
 
 from dateutil.relativedelta import relativedelta
-import wikipedia
 from werkzeug.security import generate_password_hash, check_password_hash
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
 mail = Mail()
 
 app = Flask(__name__)
@@ -22,6 +47,13 @@ app.config.from_object(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = settings.database_uri
 db = SQLAlchemy(app)
 
+# SQLite only enforces foreign keys when asked to, per connection; asking
+# makes development databases fail the way MySQL and Postgres would.
+if db.engine.dialect.name == 'sqlite':
+    @event.listens_for(db.engine, 'connect')
+    def enable_foreign_keys(dbapi_connection, connection_record):
+        dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
 app.secret_key = settings.app_secret_key
 
 # Mail config
@@ -35,6 +67,70 @@ app.config["MAIL_PASSWORD"] = settings.mail['password']
 mail.init_app(app)
 
 
+def load_static_manifest(build_dir):
+    # Original static file name -> {'path': fingerprinted name, 'encodings': [...]},
+    # as written by build_static.py; empty until it has been run.
+    path = os.path.join(build_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+static_manifest = load_static_manifest(settings.static_build_dir)
+# Changes with every build that renames an asset, so pages linking to
+# the old names stop validating.
+static_build_id = hashlib.md5(json.dumps(static_manifest, sort_keys=True).encode('utf-8')).hexdigest()[:10]
+
+# Names build_static.py gives files, e.g. bootstrap.3f2a9c1d0e.css.
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{10}(\.[^./]*)?$')
+
+
+def asset_url_for(endpoint, **values):
+    # Templates' url_for: static files that have been built get their
+    # fingerprinted /assets/ URL.
+    if endpoint == 'static' and values.get('filename') in static_manifest:
+        return url_for('assets', filename=static_manifest[values['filename']]['path'])
+    return url_for(endpoint, **values)
+
+app.jinja_env.globals['url_for'] = asset_url_for
+
+providers = build_providers(settings)
+
+# Terms this worker is fetching right now, shared by concurrent requests.
+single_flight = SingleFlight()
+
+# Per-worker cache of normalized term -> (status, value), in front of the
+# Definition table.
+definition_cache = LRUCache(settings.definition_cache['max_entries'],
+                            settings.definition_cache['max_bytes'],
+                            settings.definition_cache['ttl'])
+
+# Per-worker cache of rendered set term lists, keyed on set_cache_key().
+fragment_cache = LRUCache(settings.fragment_cache['max_entries'],
+                          settings.fragment_cache['max_bytes'],
+                          settings.fragment_cache['ttl'])
+
+metrics = Metrics(settings.metrics['directory'], settings.metrics['flush_interval'])
+metrics.describe('termlio_request_seconds', 'Time to handle a request.')
+metrics.describe('termlio_request_queries', 'SQL statements run by a request.',
+                 buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+metrics.describe('termlio_span_seconds', 'Time spent in a named part of a request.')
+metrics.describe('termlio_sql_seconds', 'Time to run an SQL statement.')
+metrics.describe('termlio_fetch_seconds', 'Time to look up a batch of terms with a provider.')
+metrics.describe('termlio_definition_lookups_total', 'Terms looked up, by where the answer came from.')
+metrics.describe('termlio_provider_calls_total', 'Calls made to a definition provider.')
+metrics.describe('termlio_provider_errors_total', 'Calls to a definition provider that failed.')
+metrics.describe('termlio_provider_short_circuits_total', 'Lookups skipped while a provider\'s circuit was open.')
+metrics.describe('termlio_cache_hits_total', 'In-process cache hits.')
+metrics.describe('termlio_cache_misses_total', 'In-process cache misses.')
+metrics.describe('termlio_cache_evictions_total', 'Entries evicted from an in-process cache.')
+
+slow_request_log = logging.getLogger('termlio.slow_requests')
+if settings.metrics['slow_request_log']:
+    slow_request_log.addHandler(logging.FileHandler(settings.metrics['slow_request_log']))
+    slow_request_log.setLevel(logging.INFO)
+
+
 # Database Setup
 
 
@@ -44,6 +140,8 @@ class User(db.Model):
     password = db.Column(db.String(100))
     is_active = db.Column(db.Boolean())
     expiration_date = db.Column(db.DateTime())
+    # SHA-256 of the user's API token; the token itself is shown only once.
+    api_token_hash = db.Column(db.String(64), unique=True, index=True)
     sets = db.relationship("Set", backref="user")
 
     def __init__(self, email, password):
@@ -58,6 +156,11 @@ class User(db.Model):
     def check_password(self, password):
         return check_password_hash(self.password, password)
 
+    def new_api_token(self):
+        token = binascii.hexlify(os.urandom(20)).decode('ascii')
+        self.api_token_hash = hash_api_token(token)
+        return token
+
     def __repr__(self):
         return '<User %r>' % self.email
 
@@ -66,35 +169,289 @@ class Set(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     title = db.Column(db.String(50))
-    terms = db.Column(db.String(4294967294))
-
-    def __init__(self, user_id, title, terms):
+    term_count = db.Column(db.Integer, default=0)
+    # Bumped, along with updated_at, whenever the set changes, to
+    # invalidate generated exports, cached fragments and browser caches.
+    version = db.Column(db.Integer, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    # Random per set, since ids of deleted sets can be handed out again.
+    token = db.Column(db.String(16))
+    __table_args__ = (db.Index('ix_set_user_id_id', 'user_id', 'id'),)
+
+    def __init__(self, user_id, title, term_count=0):
         self.user_id = user_id
         self.title = title
-        self.terms = terms
+        self.term_count = term_count
+        self.version = 1
+        self.updated_at = datetime.datetime.utcnow()
+        self.token = binascii.hexlify(os.urandom(8)).decode('ascii')
+
+    def __repr__(self):
+        return '<Set %r>' % self.title
+
+
+class SetTerm(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    set_id = db.Column(db.Integer, db.ForeignKey('set.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    term = db.Column(db.String(255))
+    definition_id = db.Column(db.Integer, db.ForeignKey('definition.id'))
+    __table_args__ = (db.Index('ix_set_term_set_id_position', 'set_id', 'position'),)
+
+    def __init__(self, set_id, position, term, definition_id):
+        self.set_id = set_id
+        self.position = position
+        self.term = term
+        self.definition_id = definition_id
 
     def __repr__(self):
-        return (self.title + " " + self.terms)
+        return '<SetTerm %r>' % self.term
+
 
 class Definition(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     term = db.Column(db.String(50))
+    term_key = db.Column(db.String(50), unique=True, index=True)
     definition = db.Column(db.String(5000))
+    # 'missing' and 'ambiguous' rows are negative cache entries that are
+    # fetched again once expires_at has passed.
+    status = db.Column(db.String(20), default=FOUND)
+    options = db.Column(db.Text)
+    expires_at = db.Column(db.DateTime)
 
     def __init__(self, term, definition):
         self.term = term
+        self.term_key = normalize_term(term)
         self.definition = definition
+        self.status = FOUND
+
+    def set_result(self, status, value):
+        self.status = status
+        self.definition = value if status == FOUND else None
+        self.options = '\n'.join(value) if status == AMBIGUOUS else None
+        self.expires_at = None
+        if status != FOUND:
+            self.expires_at = (datetime.datetime.utcnow() +
+                               datetime.timedelta(seconds=settings.definition_cache['negative_ttl']))
+
+    def result(self):
+        if self.status == AMBIGUOUS:
+            return (AMBIGUOUS, self.options.split('\n') if self.options else [])
+        elif self.status == MISSING:
+            return (MISSING, None)
+        return (FOUND, self.definition)
+
+    def is_expired(self):
+        return self.expires_at is not None and self.expires_at < datetime.datetime.utcnow()
+
+    def __repr__(self):
+        return (self.term + (self.definition or ''))
+
+
+class FetchLease(db.Model):
+    # Marks a term as being fetched by some web worker, so other workers
+    # wait for its Definition row instead of fetching it again.
+    term_key = db.Column(db.String(50), primary_key=True)
+    expires_at = db.Column(db.DateTime)
+
+    def __init__(self, term_key, expires_at):
+        self.term_key = term_key
+        self.expires_at = expires_at
+
+    def __repr__(self):
+        return '<FetchLease %r>' % self.term_key
+
+
+class SessionData(db.Model):
+    # Server-side session contents, see sessions.py.
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text)
+    expires_at = db.Column(db.DateTime, index=True)
+
+    def __init__(self, id, data, expires_at):
+        self.id = id
+        self.data = data
+        self.expires_at = expires_at
 
     def __repr__(self):
-        return (self.term + self.definition)
+        return '<SessionData %r>' % self.id
+
+
+app.session_interface = SqlSessionInterface(db, SessionData, settings.session['idle_timeout'])
+
+
+class Draft(db.Model):
+    # Resolved terms of a set that is waiting on disambiguation, so the
+    # resubmission only fetches the terms that were replaced.
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    title = db.Column(db.String(50))
+    data = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+
+    def __init__(self, user_id, title, results):
+        self.user_id = user_id
+        self.title = title
+        self.data = json.dumps(results)
+        self.created_at = datetime.datetime.utcnow()
+
+    def results(self):
+        return dict((word, tuple(result)) for word, result in json.loads(self.data).items())
+
+    def __repr__(self):
+        return '<Draft %r>' % self.title
+
+
+class Job(db.Model):
+    # A large set being defined in the background by worker.py. Status is
+    # pending, running, done, ambiguous or failed.
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    title = db.Column(db.String(50))
+    status = db.Column(db.String(20), index=True)
+    attempts = db.Column(db.Integer)
+    heartbeat = db.Column(db.DateTime)
+    set_id = db.Column(db.Integer, db.ForeignKey('set.id'))
+    draft_id = db.Column(db.Integer, db.ForeignKey('draft.id'))
+    created_at = db.Column(db.DateTime)
+
+    def __init__(self, user_id, title):
+        self.user_id = user_id
+        self.title = title
+        self.status = 'pending'
+        self.attempts = 0
+        self.created_at = datetime.datetime.utcnow()
+
+    def progress(self):
+        terms = JobTerm.query.filter_by(job_id=self.id).order_by(JobTerm.position).all()
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total': len(terms),
+            'resolved': len([term for term in terms if term.status is not None]),
+            'terms': [{'term': term.term, 'status': term.status} for term in terms],
+        }
+
+    def __repr__(self):
+        return '<Job %r>' % self.id
+
+
+class JobTerm(db.Model):
+    # One submitted term of a Job; status is set once it has been looked up.
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False)
+    term = db.Column(db.String(255))
+    status = db.Column(db.String(20))
+
+    def __init__(self, job_id, position, term):
+        self.job_id = job_id
+        self.position = position
+        self.term = term
+
+    def __repr__(self):
+        return '<JobTerm %r>' % self.term
+
+
+class OutboxMessage(db.Model):
+    # An email waiting to be sent by mailer.py. Pending messages are tried
+    # once next_attempt_at has passed; status then becomes sent, or failed
+    # after settings.outbox['max_attempts'] attempts.
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200))
+    sender = db.Column(db.String(120))
+    recipients = db.Column(db.Text)
+    body = db.Column(db.Text)
+    status = db.Column(db.String(20))
+    attempts = db.Column(db.Integer)
+    next_attempt_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_outbox_message_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+    def __init__(self, subject, sender, recipients, body):
+        self.subject = subject
+        self.sender = sender
+        self.recipients = '\n'.join(recipients)
+        self.body = body
+        self.status = 'pending'
+        self.attempts = 0
+        self.created_at = datetime.datetime.utcnow()
+        self.next_attempt_at = self.created_at
+
+    def message(self):
+        return Message(self.subject, sender=self.sender, recipients=self.recipients.split('\n'), body=self.body)
+
+    def __repr__(self):
+        return '<OutboxMessage %r>' % self.subject
 
 
 # Notification Systems
 
 
-def send_signup_email():
-    msg = Message('Terml.io Account Created', sender='support@terml.io', recipients=[session['email']])
-    msg.body = """
+def queue_email(subject, recipients, body, sender='support@terml.io'):
+    # Adds the email to the outbox as part of the caller's transaction, so
+    # it is only sent if the change it reports is committed.
+    db.session.add(OutboxMessage(subject, sender, recipients, body))
+
+
+def claim_messages():
+    # Takes a batch of due messages, leasing each one by pushing its
+    # next_attempt_at forward so other mailers leave it alone.
+    now = datetime.datetime.utcnow()
+    lease = now + datetime.timedelta(seconds=settings.outbox['lease'])
+    candidates = (OutboxMessage.query
+                  .filter(OutboxMessage.status == 'pending', OutboxMessage.next_attempt_at <= now)
+                  .order_by(OutboxMessage.next_attempt_at)
+                  .limit(settings.outbox['batch_size'])
+                  .all())
+    claimed = []
+    for message in candidates:
+        if (OutboxMessage.query
+                .filter(OutboxMessage.id == message.id,
+                        OutboxMessage.next_attempt_at == message.next_attempt_at)
+                .update({'next_attempt_at': lease}, synchronize_session=False)):
+            claimed.append(message)
+    db.session.commit()
+    return claimed
+
+
+def send_messages(messages):
+    # Sends a batch over one SMTP connection, committing after each message
+    # so a crash never sends one twice.
+    pending = list(messages)
+    try:
+        with mail.connect() as connection:
+            while pending:
+                message = pending[0]
+                try:
+                    connection.send(message.message())
+                    message.status = 'sent'
+                    message.sent_at = datetime.datetime.utcnow()
+                except (smtplib.SMTPException, socket.error) as e:
+                    retry_message(message, e)
+                pending.pop(0)
+                db.session.commit()
+    except (smtplib.SMTPException, socket.error) as e:
+        # Could not connect, or the connection dropped.
+        for message in pending:
+            retry_message(message, e)
+        db.session.commit()
+
+
+def retry_message(message, error):
+    message.attempts += 1
+    message.last_error = repr(error)
+    if message.attempts >= settings.outbox['max_attempts']:
+        message.status = 'failed'
+        return
+    delay = settings.outbox['retry_backoff'] * (2 ** (message.attempts - 1)) * random.uniform(0.5, 1.5)
+    message.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+
+
+def send_signup_email(email):
+    body = """
                 Hello,
 
                 You have successfully signed up for Terml.io!
@@ -115,11 +472,11 @@ def send_signup_email():
                 Regards,
                 The Terml.io Team
                 """
+    queue_email('Terml.io Account Created', [email], body)
 
 
-def send_payment_email():
-    msg = Message('Terml.io Subscription Success', sender='support@terml.io', recipients=[session['email']])
-    msg.body = """
+def send_payment_email(email):
+    body = """
                 Hello,
 
                 You have successfully donated to Terml.io! \n
@@ -132,51 +489,197 @@ def send_payment_email():
                 Thanks again,
                 The Terml.io Team
                 """
+    queue_email('Terml.io Subscription Success', [email], body)
 
 # Supercharged features
 
 
 @app.route('/createpdf/<setid>')
 def create_pdf(setid):
-    set = Set.query.filter_by(id=setid).first()
-
-    # Check to see if user owns set
-    user = User.query.filter_by(email=session.get('email')).first()
-    if set.user_id == user.id:
-        terms = []
-        for term in set.terms.split('>><<'):
-            if term != '':
-                terms.append(term)
-        definitions = define_terms(terms)
-        return render_template('createpdf.html', set=set, definitions=definitions, words=terms)
+    set = get_owned_set(setid)
+    if set is not None:
+        path = pdf_cache_path(set)
+        if os.path.exists(path):
+            return send_file(path, mimetype='application/pdf', conditional=True)
+        unavailable = []
+
+        def entries():
+            for term, definition in iter_set_definitions(set.id):
+                if definition == display_definition(UNAVAILABLE, None):
+                    unavailable.append(term)
+                yield term, definition
+
+        # Don't keep a file that would pin "temporarily unavailable" text.
+        chunks = write_through(path, render_pdf(set.title, entries()), lambda: not unavailable)
+        return Response(stream_with_context(chunks), mimetype='application/pdf')
     return render_template('error.html')
 
 
 @app.route('/createquizletset/<setid>', methods=['GET', 'POST'])
 def create_quizlet_set(setid):
-    set = Set.query.filter_by(id=setid).first()
-    user = User.query.filter_by(email=session.get('email')).first()
-    if set.user_id == user.id:
-        terms = []
-        for term in set.terms.split('>><<'):
-            if term != '':
-                terms.append(term)
-        definitions = quizlet_definitions(terms)
-        import_code = ''
-        for term in terms:
-            import_code += term + '\t' + definitions[term] + '\n'
-        return render_template('createquizletset.html', import_code=import_code)
-
-
-def quizlet_definitions(words):
-    definitions = {}
-    for word in words:
+    set = get_owned_set(setid)
+    if set is not None:
+        # Large sets get a download link instead of a huge text area.
+        if set.term_count > settings.quizlet_inline_limit:
+            return render_template('createquizletset.html', set=set)
+        import_code = ''.join(quizlet_row(term, definition)
+                              for term, definition in iter_set_definitions(set.id))
+        return render_template('createquizletset.html', set=set, import_code=import_code)
+    return render_template('error.html')
+
+
+@app.route('/quizletexport/<setid>')
+def quizlet_export(setid):
+    set = get_owned_set(setid)
+    if set is not None:
+        rows = (quizlet_row(term, definition).encode('utf-8')
+                for term, definition in iter_set_definitions(set.id))
+        filename = re.sub(r'[^A-Za-z0-9 _-]', '', set.title).strip() or 'set'
+        return Response(stream_with_context(rows),
+                        mimetype='text/tab-separated-values',
+                        headers={'Content-Disposition': 'attachment; filename="%s.txt"' % filename})
+    return render_template('error.html')
+
+
+def quizlet_row(term, definition):
+    # Quizlet imports one tab-separated term per line.
+    return ' '.join(term.split()) + '\t' + ' '.join(definition.split()) + '\n'
+
+
+def set_cache_key(set):
+    # Identifies one version of one set, even across reuse of its id.
+    return '%d-%s-v%d' % (set.id, set.token or '', set.version or 1)
+
+
+def pdf_cache_path(set):
+    return os.path.join(settings.pdf_cache_dir, 'set-%s.pdf' % set_cache_key(set))
+
+
+def write_through(path, chunks, keep=None):
+    # Streams chunks to the client while saving them; the file is only
+    # moved into place once it is complete, and if keep() then agrees.
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    partial = '%s.%d.%d.part' % (path, os.getpid(), id(chunks))
+    try:
+        with open(partial, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        if keep is None or keep():
+            os.rename(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def remove_exports(setid):
+    for path in glob.glob(os.path.join(settings.pdf_cache_dir, 'set-%d-*.pdf' % int(setid))):
+        os.remove(path)
+
+# Instrumentation
+
+
+@contextmanager
+def span(name):
+    # Times a named part of the current request.
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        metrics.observe('termlio_span_seconds', elapsed, span=name)
+        if has_request_context():
+            g.spans.append((name, elapsed))
+
+
+def timed_lookup(provider):
+    def lookup(words):
+        start = time.time()
         try:
-            definition = wikipedia.summary(word, sentences=2)
-            definitions[word] = definition
-        except wikipedia.exceptions.PageError:
-            definitions[word] = 'No definition found.'
-    return definitions
+            return provider.lookup(words)
+        finally:
+            metrics.observe('termlio_fetch_seconds', time.time() - start, provider=provider.name)
+    return lookup
+
+
+def provider_totals():
+    for provider in providers:
+        stats = provider.stats()
+        for name in ('calls', 'errors', 'short_circuits'):
+            yield 'termlio_provider_%s_total' % name, {'provider': provider.name}, stats[name]
+
+
+def cache_totals():
+    for cache, name in ((definition_cache, 'definition'), (fragment_cache, 'fragment')):
+        stats = cache.stats()
+        for result in ('hits', 'misses', 'evictions'):
+            yield 'termlio_cache_%s_total' % result, {'cache': name}, stats[result]
+
+
+metrics.register(provider_totals)
+metrics.register(cache_totals)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.time() - conn.info['query_start'].pop()
+    metrics.observe('termlio_sql_seconds', elapsed)
+    if has_request_context() and hasattr(g, 'queries'):
+        g.queries += 1
+        g.query_time += elapsed
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+    g.spans = []
+    g.queries = 0
+    g.query_time = 0.0
+
+
+@app.after_request
+def record_request(response):
+    elapsed = time.time() - g.request_start
+    endpoint = request.endpoint or 'none'
+    metrics.observe('termlio_request_seconds', elapsed, endpoint=endpoint,
+                    method=request.method, status=response.status_code)
+    metrics.observe('termlio_request_queries', g.queries, endpoint=endpoint)
+    if elapsed >= settings.metrics['slow_request']:
+        slow_request_log.info('%s %s %d %.3fs: %d queries in %.3fs; %s', request.method, request.path,
+                              response.status_code, elapsed, g.queries, g.query_time,
+                              ', '.join('%s %.3fs' % (name, seconds) for name, seconds in g.spans) or 'no spans')
+    metrics.maybe_flush()
+    return response
+
+
+@app.route('/assets/<path:filename>')
+def assets(filename):
+    # Fingerprinted files never change, so they may be cached for good.
+    # Files of earlier builds are served too, for pages that still link
+    # to them. Clients get the smallest precompressed copy they accept.
+    path = safe_join(settings.static_build_dir, filename) if FINGERPRINTED.search(filename) else None
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    for accepted, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[accepted] > 0 and os.path.isfile(path + suffix):
+            encoding = accepted
+            path += suffix
+            break
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 
 # Backend Code
 
@@ -188,55 +691,487 @@ def valid_email(email):
     return True
 
 
-def define_terms(words):
-    definitions = {}
+def fetch_definitions(words):
+    # Asks each provider in turn for the words still unanswered; remote
+    # providers are queried in concurrent batches. Results are in the
+    # order of words.
+    results = {}
+    remaining = words
+    for provider in providers:
+        if not remaining:
+            break
+        with span('fetch_' + provider.name):
+            if provider.remote:
+                answers = fetch_all(remaining, timed_lookup(provider), settings.fetch['workers'],
+                                    settings.fetch['timeout'], provider.batch_size)
+            else:
+                answers = timed_lookup(provider)(remaining)
+        for word, result in zip(remaining, answers):
+            if result[0] != UNAVAILABLE:
+                results[word] = result
+        remaining = [word for word in remaining if word not in results]
+    return [results.get(word, (UNAVAILABLE, None)) for word in words]
+
+
+def unique_words(words):
+    seen = set()
+    unique = []
     for word in words:
-        cached_definition = Definition.query.filter_by(term=word).first()
-        if cached_definition is not None:
-            definitions[word] = cached_definition.definition
+        if word not in seen:
+            seen.add(word)
+            unique.append(word)
+    return unique
+
+
+def normalize_term(term):
+    # Case-folded with whitespace collapsed; used as Definition.term_key.
+    return ' '.join(term.split()).lower()
+
+
+def cached_definitions(words):
+    # Looks up every word with one indexed IN query per 500 keys.
+    keys = unique_words([normalize_term(word) for word in words])
+    cached = {}
+    for chunk in chunks(keys, 500):
+        for definition in Definition.query.filter(Definition.term_key.in_(chunk)):
+            cached[definition.term_key] = definition
+    return cached
+
+
+def resolve_terms(words, commit=True):
+    # Maps each word to a (status, value) pair: worker memory first, then
+    # the Definition table, then Wikipedia. Fetched terms are written back;
+    # with commit=False the caller commits them with its own changes.
+    keys = {}
+    for word in unique_words(words):
+        keys.setdefault(normalize_term(word), []).append(word)
+    found, stale = stored_results(keys)
+    fetch = dict((key, keys[key][0]) for key in keys if key not in found)
+    metrics.inc('termlio_definition_lookups_total', len(fetch), source='fetch')
+    found.update(fetch_coalesced(fetch, stale, commit))
+    results = {}
+    for key, group in keys.items():
+        for word in group:
+            results[word] = found[key]
+    return results
+
+
+def stored_results(keys):
+    # Answers normalized keys from worker memory, then the Definition
+    # table. Returns key -> result, and key -> row for expired rows.
+    found = definition_cache.get_many(keys)
+    in_memory = len(found)
+    metrics.inc('termlio_definition_lookups_total', in_memory, source='memory')
+    stale = {}
+    for key, definition in cached_definitions([key for key in keys if key not in found]).items():
+        if definition.is_expired():
+            stale[key] = definition
         else:
+            found[key] = definition.result()
+            definition_cache.set(key, found[key], ttl=cache_ttl(found[key][0]))
+    metrics.inc('termlio_definition_lookups_total', len(found) - in_memory, source='database')
+    return found, stale
+
+
+def fetch_and_store(words, stale, commit=True):
+    # words maps normalized keys to the word to fetch; returns key -> result.
+    keys = list(words)
+    fetched = dict(zip(keys, fetch_definitions([words[key] for key in keys])))
+    store_definitions(dict((words[key], result) for key, result in fetched.items()), stale, commit)
+    return fetched
+
+
+def fetch_coalesced(words, stale, commit=True):
+    # Like fetch_and_store, but concurrent requests for the same key share
+    # one fetch: within this worker through single_flight, and across
+    # workers through FetchLease rows.
+    if not words:
+        return {}
+    owned, waiting = single_flight.claim(list(words))
+    results = {}
+    try:
+        leased, busy = acquire_leases(owned)
+        try:
+            results.update(fetch_and_store(dict((key, words[key]) for key in leased), stale, False))
+        finally:
+            release_leases(leased, commit)
+        results.update(await_definitions(busy))
+    finally:
+        single_flight.finish(owned, results)
+    for key, call in waiting.items():
+        result = call.wait(settings.fetch['timeout'])
+        if result is not None:
+            results[key] = result
+    # Whoever we waited on gave up or died; fetch the rest ourselves.
+    results.update(fetch_and_store(dict((key, words[key]) for key in words if key not in results),
+                                   stale, commit))
+    return results
+
+
+def acquire_leases(keys):
+    # Returns (keys now leased to this worker, keys another worker holds).
+    if not keys:
+        return [], []
+    now = datetime.datetime.utcnow()
+    held = set()
+    for chunk in chunks(keys, 500):
+        (FetchLease.query
+         .filter(FetchLease.term_key.in_(chunk), FetchLease.expires_at < now)
+         .delete(synchronize_session=False))
+        held.update(lease.term_key for lease in FetchLease.query.filter(FetchLease.term_key.in_(chunk)))
+    expires_at = now + datetime.timedelta(seconds=settings.fetch['lease'])
+    free = [key for key in keys if key not in held]
+    db.session.add_all([FetchLease(key, expires_at) for key in free])
+    try:
+        db.session.commit()
+        leased = free
+    except IntegrityError:
+        # Lost a race for some key; take the others one at a time.
+        db.session.rollback()
+        leased = []
+        for key in free:
+            db.session.add(FetchLease(key, expires_at))
             try:
-                definition = wikipedia.summary(word, sentences=2)
-                definitions[word] = definition
-            except wikipedia.exceptions.DisambiguationError as e:
-                suggestions = return_suggestions(word, e)
-                error = word + " has multiple definitions. Please type one of these: " + suggestions
-                return render_template('create.html', words=words, error=error)
-            except wikipedia.exceptions.PageError as e:
-                definitions[word] = "No definition found."
-    return definitions
-
-
-def return_suggestions(term, e):
-    suggestions = ""
-    for sug in e.options:
-        if(e.options.index(sug) == len(e.options) - 1):
-            suggestions += (sug + ".")
+                db.session.commit()
+                leased.append(key)
+            except IntegrityError:
+                db.session.rollback()
+                held.add(key)
+    return leased, [key for key in keys if key in held]
+
+
+def release_leases(keys, commit=True):
+    for chunk in chunks(keys, 500):
+        FetchLease.query.filter(FetchLease.term_key.in_(chunk)).delete(synchronize_session=False)
+    if commit:
+        db.session.commit()
+
+
+def await_definitions(keys):
+    # Polls for the Definition rows another worker is fetching; returns
+    # key -> result for those that appeared in time. Keys whose lease is
+    # gone without a row (the fetch was unavailable or failed, or the
+    # holder died) are given up on straight away.
+    results = {}
+    pending = list(keys)
+    deadline = time.time() + settings.fetch['timeout']
+    while pending and time.time() < deadline:
+        time.sleep(0.1)
+        # End the transaction so the next query sees the other worker's rows.
+        db.session.commit()
+        # Leases are read first: the holder stores its rows in the same
+        # commit that releases them, so a released key's row is visible
+        # to the query below.
+        now = datetime.datetime.utcnow()
+        leased = set()
+        for chunk in chunks(pending, 500):
+            leased.update(term_key for term_key, in
+                          db.session.query(FetchLease.term_key)
+                          .filter(FetchLease.term_key.in_(chunk), FetchLease.expires_at >= now))
+        for key, definition in cached_definitions(pending).items():
+            if not definition.is_expired():
+                results[key] = definition.result()
+                definition_cache.set(key, results[key], ttl=cache_ttl(results[key][0]))
+        pending = [key for key in pending if key not in results and key in leased]
+    return results
+
+
+def cache_ttl(status):
+    if status == FOUND:
+        return settings.definition_cache['ttl']
+    return min(settings.definition_cache['ttl'], settings.definition_cache['negative_ttl'])
+
+
+def definition_row(word, result, row=None):
+    if row is None:
+        row = Definition(word, None)
+    row.set_result(*result)
+    return row
+
+
+def store_definitions(fetched, stale=None, commit=True):
+    # Saves fetched results, including 'no page' and disambiguation
+    # results, in one multi-row insert that skips terms another request
+    # stored first. stale maps keys to expired rows updated in place.
+    stale = stale or {}
+    rows = []
+    for word, result in fetched.items():
+        if result[0] == UNAVAILABLE:
+            continue
+        key = normalize_term(word)
+        definition_cache.set(key, result, ttl=cache_ttl(result[0]))
+        if key in stale:
+            stale[key].set_result(*result)
         else:
-            suggestions += (sug + ", ")
-    return suggestions
+            row = definition_row(word, result)
+            rows.append(dict((column.name, getattr(row, column.name))
+                             for column in Definition.__table__.columns if column.name != 'id'))
+    insert_ignore(Definition.__table__, rows)
+    if commit:
+        db.session.commit()
+
+
+def insert_ignore(table, rows):
+    # Inserts rows in one statement, skipping any that would violate a
+    # unique key (INSERT OR IGNORE / INSERT IGNORE).
+    if not rows:
+        return
+    if db.engine.dialect.name in ('sqlite', 'mysql'):
+        statement = (table.insert()
+                     .prefix_with('OR IGNORE', dialect='sqlite')
+                     .prefix_with('IGNORE', dialect='mysql'))
+        db.session.execute(statement, rows)
+        return
+    # Other databases get a savepoint per row, still in one transaction.
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert(), row)
+        except IntegrityError:
+            pass
+
+
+def display_definition(status, value):
+    if status == FOUND:
+        return value
+    elif status == UNAVAILABLE:
+        return "Definition temporarily unavailable."
+    return "No definition found."
+
+
+def load_set_terms(set_id):
+    # One joined query for a set's terms, in order, with their cached
+    # definitions. Selecting the position keeps repeated terms, since a
+    # query for an entity drops duplicate rows.
+    return (db.session.query(SetTerm.position, SetTerm.term, Definition)
+            .outerjoin(Definition, SetTerm.definition_id == Definition.id)
+            .filter(SetTerm.set_id == set_id)
+            .order_by(SetTerm.position)
+            .all())
+
+
+def iter_set_definitions(set_id):
+    # Yields a set's (word, definition) pairs in order. Terms that had no
+    # usable definition when the set was saved are looked up again, a
+    # chunk at a time, so exports can start before every term resolves.
+    # Results are read up front: the commits that store refetched terms
+    # expire every loaded row.
+    rows = [(term, definition.result() if definition is not None and not definition.is_expired() else None)
+            for position, term, definition in load_set_terms(set_id)]
+    for chunk in chunks(rows, settings.wikipedia['batch_size']):
+        results = dict((term, result) for term, result in chunk if result is not None)
+        results.update(resolve_terms([term for term, result in chunk if result is None]))
+        for term, result in chunk:
+            yield term, display_definition(*results[term])
+
+
+def set_definitions(set_id):
+    # Returns a set's words and a dict of their definitions.
+    words = []
+    definitions = {}
+    for word, definition in iter_set_definitions(set_id):
+        words.append(word)
+        definitions[word] = definition
+    return words, definitions
+
+
+def save_set(user_id, title, words, commit=True):
+    # Saves the set and its terms, along with anything else pending in
+    # the session, in a single commit; with commit=False the caller
+    # commits.
+    set = Set(user_id, title, len(words))
+    db.session.add(set)
+    db.session.flush()
+    cached = cached_definitions(words)
+    rows = []
+    for position, word in enumerate(words):
+        definition = cached.get(normalize_term(word))
+        rows.append({'set_id': set.id, 'position': position, 'term': word,
+                     'definition_id': definition.id if definition is not None else None})
+    if rows:
+        db.session.execute(SetTerm.__table__.insert(), rows)
+    if commit:
+        db.session.commit()
+    return set
+
+
+def render_set_terms(set, words=None, definitions=None):
+    # Returns a set's rendered term list and whether it is complete, that
+    # is, no definition in it is temporarily unavailable. Complete lists
+    # are cached per set version.
+    key = set_cache_key(set)
+    html = fragment_cache.get(key)
+    if html is not None:
+        return Markup(html), True
+    if words is None:
+        words, definitions = set_definitions(set.id)
+    html = render_template('set_terms.html', set=set, words=words, definitions=definitions)
+    complete = display_definition(UNAVAILABLE, None) not in definitions.values()
+    if complete:
+        fragment_cache.set(key, html)
+    return Markup(html), complete
+
+
+def set_etag(set):
+    # One version of a set page as seen by the signed-in user, whose name
+    # is in the page header, with the asset links of the current build.
+    return hashlib.md5(('%s-%s-%s' % (set_cache_key(set), static_build_id, session.get('username', '')))
+                       .encode('utf-8')).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    # Whether the copy the browser has (If-None-Match, or failing that
+    # If-Modified-Since) is still current.
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since is None or last_modified is None:
+        return False
+    return request.if_modified_since >= last_modified.replace(microsecond=0)
+
+
+def list_sets(user_id, before=None):
+    # One page of a user's sets, newest first, keyed on the set id so deep
+    # pages cost the same as the first. Returns the page and the id to
+    # continue from, or None on the last page.
+    query = (db.session.query(Set.id, Set.title, Set.term_count)
+             .filter(Set.user_id == user_id))
+    if before is not None:
+        query = query.filter(Set.id < before)
+    page_size = settings.review_page_size
+    sets = query.order_by(Set.id.desc()).limit(page_size + 1).all()
+    if len(sets) > page_size:
+        return sets[:page_size], sets[page_size - 1].id
+    return sets, None
+
+
+def delete_drafts(query):
+    # Deletes the drafts matched by query, first unlinking any job that
+    # still points at one of them.
+    ids = [draft_id for draft_id, in query.with_entities(Draft.id)]
+    if ids:
+        (Job.query.filter(Job.draft_id.in_(ids))
+         .update({'draft_id': None}, synchronize_session=False))
+        Draft.query.filter(Draft.id.in_(ids)).delete(synchronize_session=False)
+
+
+def save_draft(user_id, title, results):
+    # Users keep at most one draft; unavailable terms are retried next time.
+    delete_drafts(Draft.query.filter_by(user_id=user_id))
+    resolved = dict((word, result) for word, result in results.items()
+                    if result[0] not in (AMBIGUOUS, UNAVAILABLE))
+    draft = Draft(user_id, title, resolved)
+    db.session.add(draft)
+    db.session.commit()
+    return draft
+
+
+def queue_job(user_id, title, words):
+    job = Job(user_id, title)
+    db.session.add(job)
+    db.session.flush()
+    for position, word in enumerate(words):
+        db.session.add(JobTerm(job.id, position, word))
+    db.session.commit()
+    return job
+
+
+def claim_job():
+    # Atomically takes the oldest pending job, or a running one whose
+    # worker stopped sending heartbeats.
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.jobs['lease'])
+    candidates = (Job.query
+                  .filter(or_(Job.status == 'pending',
+                              (Job.status == 'running') & (Job.heartbeat < stale)))
+                  .order_by(Job.id)
+                  .limit(10)
+                  .all())
+    for job in candidates:
+        claimed = (Job.query
+                   .filter(Job.id == job.id, Job.status == job.status, Job.heartbeat == job.heartbeat)
+                   .update({'status': 'running',
+                            'heartbeat': datetime.datetime.utcnow(),
+                            'attempts': Job.attempts + 1},
+                           synchronize_session=False))
+        db.session.commit()
+        if claimed:
+            db.session.refresh(job)
+            return job
+    return None
+
+
+def run_job(job):
+    # Looks terms up a batch at a time, recording progress and a heartbeat
+    # after each batch, then saves the set (or a draft if any term is
+    # ambiguous).
+    if job.attempts > settings.jobs['max_attempts']:
+        job.status = 'failed'
+        db.session.commit()
+        return
+    terms = JobTerm.query.filter_by(job_id=job.id).order_by(JobTerm.position).all()
+    for chunk in chunks([term for term in terms if term.status is None], settings.wikipedia['batch_size']):
+        results = resolve_terms([term.term for term in chunk])
+        for term in chunk:
+            term.status = results[term.term][0]
+        job.heartbeat = datetime.datetime.utcnow()
+        db.session.commit()
+    words = [term.term for term in terms]
+    results = resolve_terms(words)
+    if AMBIGUOUS in [status for status, value in results.values()]:
+        job.draft_id = save_draft(job.user_id, job.title, results).id
+        job.status = 'ambiguous'
+    else:
+        job.set_id = save_set(job.user_id, job.title, words).id
+        job.status = 'done'
+    db.session.commit()
 
 
 def remove_blank_words(termlist):
-    wordlist = termlist
-    for word in wordlist:
-        if word == "":
-            wordlist.remove(word)
-    return wordlist
+    return [word for word in termlist if word != ""]
 
 
 def delete_set(setid):
     set = Set.query.filter_by(id=setid).first()
+    SetTerm.query.filter_by(set_id=set.id).delete()
+    # The job that made the set now shows it as gone.
+    Job.query.filter_by(set_id=set.id).update({'set_id': None}, synchronize_session=False)
     db.session.delete(set)
     db.session.commit()
+    remove_exports(set.id)
+    fragment_cache.delete(set_cache_key(set))
+
+
+def current_user():
+    # The signed-in user, loaded at most once per request.
+    if not hasattr(g, 'user'):
+        user_id = session.get('user_id')
+        g.user = User.query.get(user_id) if user_id is not None else None
+    return g.user
+
+
+def get_owned_set(setid):
+    # The set if it belongs to the signed-in user, otherwise None, in one
+    # primary key lookup.
+    user_id = session.get('user_id')
+    if user_id is None:
+        return None
+    return Set.query.filter_by(id=setid, user_id=user_id).first()
 
 
 def user_owns_set(setid):
-    user = User.query.filter_by(email=session.get('email'))
-    set = Set.query.filter_by(id=setid)
-    if set.user_id == user.id:
-        return True
-    return False
+    return get_owned_set(setid) is not None
+
+
+def username(email):
+    return email.split('@')[0]
+
+
+def sign_in(user):
+    session.regenerate()
+    session['logged_in'] = True
+    session['user_id'] = user.id
+    session['email'] = user.email
+    session['username'] = username(user.email)
+    session['is_active'] = user.is_active
 
 
 def generate_random_password():
@@ -271,7 +1206,7 @@ def index():
 def create():
     error = None
     if session.get('logged_in'):
-        user = User.query.filter_by(email=session['email']).first()
+        user = current_user()
         '''
         qs = request.query_string
         if qs:
@@ -295,101 +1230,266 @@ def create():
         if request.method == 'POST':
             settitle = request.form['settitle']
             terms = request.form['terms']
-            words = terms.split('\n')
+            words = [word.strip() for word in terms.split('\n')]
             words = remove_blank_words(words)
-            session['words'] = words
-            session['title'] = settitle
-            dbtitle = settitle
-            dbwords = ''
-            for word in words:
-                dbwords += word + '>><<'
             lenwords = len(words)
-            if len(terms) != 0:
+            if lenwords > settings.jobs['threshold']:
+                job = queue_job(user.id, settitle, words)
+                return redirect('/jobs/%d' % job.id)
+            if words:
+                draft = None
+                if request.form.get('draft'):
+                    draft = Draft.query.filter_by(id=request.form['draft'], user_id=user.id).first()
+                results = draft.results() if draft is not None else {}
+                # New definitions are committed together with the set (or draft).
+                with span('resolve'):
+                    results.update(resolve_terms([word for word in words if word not in results], commit=False))
                 definitions = {}
-                for word in words:
-                    cached_definition = Definition.query.filter_by(term=word).first()
-                    if cached_definition is not None:
-                        definitions[word] = cached_definition.definition
+                ambiguous = []
+                for word in unique_words(words):
+                    status, value = results[word]
+                    if status == AMBIGUOUS:
+                        ambiguous.append((word, value[:3]))
                     else:
-                        try:
-                            definition = wikipedia.summary(word, sentences=2)
-                            definitions[word] = definition
-                            add_definition = Definition(word, definition)
-                            db.session.add(add_definition)
-                            db.session.commit()
-                        except wikipedia.exceptions.DisambiguationError as e:
-                            suggestions = return_suggestions(word, e)
-                            suggestions = suggestions.split(', ')
-                            suggestions = suggestions[:3]
-                            error_word = word
-                            error = error_word + " has multiple definitions. Replace it with the term most closely relating to yours: "
-                            return render_template('create.html', settitle=settitle, words=words, error_word=error_word, error=error, suggestions=suggestions)
-                        except wikipedia.exceptions.PageError as e:
-                            definitions[word] = "No definition found."
-                set = Set(user.id, dbtitle, dbwords)
-                db.session.add(set)
-                db.session.commit()
-                setid = set.id
-                return render_template('definitions.html', set=set, words=words,
-                                       lenwords=lenwords,
-                                       definitions=definitions, setid=setid)
+                        definitions[word] = display_definition(status, value)
+                if ambiguous:
+                    draft = save_draft(user.id, settitle, results)
+                    error = "Some terms have multiple definitions. Replace each with the term most closely relating to yours:"
+                    return render_template('create.html', settitle=settitle, words=words, error=error,
+                                           ambiguous=ambiguous, draft_id=draft.id)
+                if draft is not None:
+                    delete_drafts(Draft.query.filter_by(id=draft.id))
+                try:
+                    with span('save'):
+                        set = save_set(user.id, settitle, words)
+                except SQLAlchemyError:
+                    # Keep what was fetched even though the set failed.
+                    db.session.rollback()
+                    store_definitions(results)
+                    raise
+                with span('render'):
+                    return render_template('definitions.html', set=set,
+                                           terms_html=render_set_terms(set, words, definitions)[0])
             error = "Please enter terms to define."
         return render_template('create.html', error=error)
         return render_template('activationneeded.html')
     return render_template('signin.html')
 
 
+@app.route('/jobs/<jobid>')
+def job_status(jobid):
+    if session.get('logged_in'):
+        user = current_user()
+        job = Job.query.filter_by(id=jobid, user_id=user.id).first()
+        if job is None:
+            return render_template('error.html'), 404
+        if request.args.get('format') == 'json':
+            return jsonify(job.progress())
+        if job.status == 'done':
+            set = Set.query.filter_by(id=job.set_id).first()
+            if set is None:
+                # Deleted since the job finished.
+                return render_template('error.html')
+            return render_template('definitions.html', set=set, terms_html=render_set_terms(set)[0])
+        if job.status == 'ambiguous':
+            words = [term.term for term in JobTerm.query.filter_by(job_id=job.id).order_by(JobTerm.position)]
+            results = resolve_terms(words)
+            ambiguous = [(word, results[word][1][:3]) for word in unique_words(words)
+                         if results[word][0] == AMBIGUOUS]
+            error = "Some terms have multiple definitions. Replace each with the term most closely relating to yours:"
+            # A list over the threshold is queued again when resubmitted,
+            # and jobs start from scratch rather than from a draft.
+            draft_id = job.draft_id if len(words) <= settings.jobs['threshold'] else None
+            return render_template('create.html', settitle=job.title, words=words, error=error,
+                                   ambiguous=ambiguous, draft_id=draft_id)
+        return render_template('job.html', job=job)
+    return render_template('signin.html')
+
+
 @app.route('/review', methods=['GET', 'POST'])
 def review():
     if session.get('logged_in'):
-        user = User.query.filter_by(email=session.get('email')).first()
-        sets = Set.query.filter_by(user_id=user.id).all()
-        sets_length = len(sets)
-        length_of_sets = {}
-        for set in sets:
-            count = 0
-            for term in set.terms.split('>><<'):
-                if term != '':
-                    count += 1
-            length_of_sets[set] = count
-        return render_template('review.html', sets=sets, definitions=definitions, sets_length=sets_length, length_of_sets=length_of_sets)
+        user = current_user()
+        before = request.args.get('before', type=int)
+        sets, next_page = list_sets(user.id, before)
+        return render_template('review.html', sets=sets, before=before, next_page=next_page)
     return render_template('signin.html')
 
 
 @app.route('/definitions/<setid>')
 def definitions(setid):
-    set = Set.query.filter_by(id=setid).first()
-    user = User.query.filter_by(email=session.get('email')).first()
-    if set.user_id == user.id:
-        terms = []
-        for term in set.terms.split('>><<'):
-            if term != '':
-                terms.append(term)
-        definitions = define_terms(terms)
-        return render_template('definitions.html', set=set, definitions=definitions, words=terms)
+    set = get_owned_set(setid)
+    if set is not None:
+        etag = set_etag(set)
+        if not_modified(etag, set.updated_at):
+            response = Response(status=304)
+        else:
+            terms_html, complete = render_set_terms(set)
+            response = make_response(render_template('definitions.html', set=set, terms_html=terms_html))
+            # A page that says a definition is unavailable should be
+            # fetched again, so it gets no validators.
+            if not complete:
+                return response
+        response.set_etag(etag)
+        if set.updated_at is not None:
+            response.last_modified = set.updated_at
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
     return render_template('error.html')
 
 
 @app.route('/deleteset/<setid>')
 def delete_set_page(setid):
-    set = Set.query.filter_by(id=setid).first()
-    user = User.query.filter_by(email=session.get('email')).first()
-    if 1  == 1:
+    set = get_owned_set(setid)
+    if set is not None:
         delete_set(set.id)
-        message = 'You have successfully removed ' + set.title + ' from your sets.'
-        sets = Set.query.filter_by(user_id=user.id).all()
-        sets_length = len(sets)
-        length_of_sets = {}
-        for set in sets:
-            count = 0
-            for term in set.terms.split('>><<'):
-                if term != '':
-                    count += 1
-            length_of_sets[set] = count
-        return render_template('review.html', sets=sets, definitions=definitions, sets_length=sets_length, length_of_sets=length_of_sets, message=message)
+        flash('You have successfully removed ' + set.title + ' from your sets.')
+        return redirect('/review')
     return render_template('error.html')
 
 
+@app.route('/metrics')
+def metrics_page():
+    # Needs the configured token; the address check alone lets everything
+    # through behind a reverse proxy on the same host.
+    token = settings.metrics['token']
+    header = request.headers.get('Authorization', '')
+    if (not token or not hmac.compare_digest(header.encode('utf-8'), ('Bearer ' + token).encode('utf-8'))
+            or request.remote_addr not in settings.metrics['allowed_ips']):
+        return render_template('error.html'), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# JSON API
+
+
+def hash_api_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def api_user():
+    # The user whose token is in the 'Authorization: Bearer' header.
+    if not hasattr(g, 'api_user'):
+        g.api_user = None
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer ') and header[7:].strip():
+            g.api_user = User.query.filter_by(api_token_hash=hash_api_token(header[7:].strip())).first()
+    return g.api_user
+
+
+def api_error(message, status):
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
+
+
+def api_terms(value):
+    # The non-blank terms of a JSON list of strings, or None if it is not one.
+    if not isinstance(value, list) or not all(isinstance(term, string_types) for term in value):
+        return None
+    return remove_blank_words([term.strip() for term in value])
+
+
+def api_body():
+    # The request's JSON object, or an empty one for anything else.
+    body = request.get_json(silent=True)
+    return body if isinstance(body, dict) else {}
+
+
+def api_result(term, result):
+    status, value = result
+    item = {'term': term, 'status': status, 'definition': value if status == FOUND else None}
+    if status == AMBIGUOUS:
+        item['options'] = value
+    return item
+
+
+@app.route('/api/definitions', methods=['POST'])
+def api_definitions():
+    # Takes {"terms": [...]} and streams one JSON object per line for each
+    # distinct term: stored answers straight away, then the rest as each
+    # batch is fetched.
+    if api_user() is None:
+        return api_error('A valid API token is required.', 401)
+    words = api_terms(api_body().get('terms'))
+    if not words:
+        return api_error('terms must be a non-empty list of strings.', 400)
+    if len(words) > settings.api['max_terms']:
+        return api_error('At most %d terms per request.' % settings.api['max_terms'], 400)
+    keys = {}
+    for word in unique_words(words):
+        keys.setdefault(normalize_term(word), []).append(word)
+
+    def lines(result, key):
+        return ''.join(json.dumps(api_result(word, result)) + '\n' for word in keys[key])
+
+    def results():
+        found, stale = stored_results(keys)
+        for key, result in found.items():
+            yield lines(result, key)
+        missing = [key for key in keys if key not in found]
+        metrics.inc('termlio_definition_lookups_total', len(missing), source='fetch')
+        for chunk in chunks(missing, settings.wikipedia['batch_size'] * settings.fetch['workers']):
+            fetched = fetch_coalesced(dict((key, keys[key][0]) for key in chunk), stale)
+            for key in chunk:
+                yield lines(fetched.get(key, (UNAVAILABLE, None)), key)
+
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/sets', methods=['POST'])
+def api_sets():
+    # Takes {"sets": [{"title": ..., "terms": [...]}, ...]} and saves them
+    # all in one transaction. Ambiguous terms are saved without a
+    # definition and listed with their options in the response.
+    user = api_user()
+    if user is None:
+        return api_error('A valid API token is required.', 401)
+    sets = api_body().get('sets')
+    if not isinstance(sets, list) or not sets:
+        return api_error('sets must be a non-empty list.', 400)
+    if len(sets) > settings.api['max_sets']:
+        return api_error('At most %d sets per request.' % settings.api['max_sets'], 400)
+    parsed = []
+    for number, item in enumerate(sets):
+        title = item.get('title') if isinstance(item, dict) else None
+        words = api_terms(item.get('terms')) if isinstance(item, dict) else None
+        if not isinstance(title, string_types) or not 0 < len(title.strip()) <= 50 or not words:
+            return api_error('sets[%d] needs a title of up to 50 characters and a non-empty '
+                             'list of terms.' % number, 400)
+        parsed.append((title.strip(), words))
+    if sum(len(words) for title, words in parsed) > settings.api['max_terms']:
+        return api_error('At most %d terms per request.' % settings.api['max_terms'], 400)
+
+    results = resolve_terms([word for title, words in parsed for word in words], commit=False)
+    created = []
+    for title, words in parsed:
+        set = save_set(user.id, title, words, commit=False)
+        created.append({
+            'id': set.id,
+            'title': title,
+            'term_count': len(words),
+            'url': '/definitions/%d' % set.id,
+            'ambiguous': [api_result(word, results[word]) for word in unique_words(words)
+                          if results[word][0] == AMBIGUOUS],
+        })
+    db.session.commit()
+    response = jsonify(sets=created)
+    response.status_code = 201
+    return response
+
+
+@app.route('/apitoken', methods=['POST'])
+def api_token():
+    if session.get('logged_in'):
+        token = current_user().new_api_token()
+        db.session.commit()
+        message = 'Your new API token is %s. Keep it safe; it will not be shown again.' % token
+        return render_template('account.html', message=message)
+    return render_template('signin.html')
+
+
 @app.route('/about')
 def about():
     return render_template('about.html')
@@ -413,10 +1513,11 @@ def changeemail():
         error = None
         if valid_email(request.form['email']):
             if User.query.filter_by(email=request.form['email']).first() == None:
-                user = User.query.filter_by(email=session.get('email')).first()
+                user = current_user()
                 user.email = request.form['email']
                 db.session.commit()
                 session['email'] = user.email
+                session['username'] = username(user.email)
                 message = 'You have successfully changed your email to ' + user.email
             else:
                 error = 'A user with that email already exists.'
@@ -430,7 +1531,7 @@ def changepassword():
     message = None
     error = None
     if session.get('logged_in'):
-        user = User.query.filter_by(email=session.get('email')).first()
+        user = current_user()
         current_password = request.form['current']
         new_password = request.form['new']
         confirm = request.form['confirm']
@@ -459,16 +1560,7 @@ def signin():
                 if user.check_password(password) == False:
                     error = 'Invalid password.'
                 else:
-                    session['logged_in'] = True
-                    session['email'] = user.email
-                    session['is_active'] = user.is_active
-                    session['username'] = ''
-                    for letter in user.email:
-                        if letter != '@':
-                            session['username'] += letter
-                        elif letter == '@':
-                            break
-                    date_today = datetime.datetime.today()
+                    sign_in(user)
                     return redirect('/')
                 return render_template('signin.html', error=error)
             error = 'Invalid email address.'
@@ -479,7 +1571,7 @@ def signin():
 @app.route('/signout')
 def signout():
     if session.get('logged_in'):
-        session['logged_in'] = False
+        session.clear()
         return redirect('/')
     return redirect('/')
 
@@ -496,19 +1588,10 @@ def signup():
             password = form.password.data
             user = User(email, password)
             db.session.add(user)
+            send_signup_email(email)
             db.session.commit()
-            # send_signup_email()
             message = 'You have successfully signed up for Terml.io.'
-            session['logged_in'] = True
-            session['email'] = user.email
-            session['username'] = ''
-            for letter in user.email:
-                if letter != '@':
-                    session['username'] += letter
-                elif letter == '@':
-                    break
-            session['is_active'] = user.is_active
-            session['expiration_date'] = user.expiration_date
+            sign_in(user)
             return render_template('index.html', message=message)
         error = 'That email is already being used by another account. Please sign in, or use a different email.'
         return render_template('signup.html', form=form, error=error)
@@ -525,10 +1608,8 @@ def forgotpassword():
 
             # Change password in db to temp password
             user.set_password(temp_password)
-            db.session.commit()
 
-            # Send email with temp password
-            msg = Message('Terml.io password reset', sender='support@terml.io', recipients=[request.form['email']])
+            # Queue email with temp password
             body = """
     Hello, \n
 
@@ -547,8 +1628,8 @@ def forgotpassword():
     -The Terml.io Team
 
                         """ % temp_password
-            msg.body = body
-            mail.send(msg)
+            queue_email('Terml.io password reset', [user.email], body)
+            db.session.commit()
             return render_template('forgotpasswordwait.html', email=email)
         error = 'An account with the email \'%s\' does not exist.' % email
         return render_template('forgotpassword.html', error=error)
@@ -0,0 +1,123 @@
+"""Prefetch definitions for term lists before teachers need them.
+
+    python warm_cache.py biology.txt chemistry.txt [--sets] [--rps 5] [--progress warm.json]
+
+Term files have one term per line; --sets adds every term of every saved
+set. Terms already in the Definition table are skipped, and the rest are
+looked up through the provider chain and stored, so the first /create of
+a list is answered from the database. --rps caps the HTTP requests sent
+to Wikipedia per second, counting searches, disambiguation links and
+continuations as well as the lookups themselves.
+
+With --progress, the position reached and the running counts are saved
+after every round, and a rerun with the same inputs carries on from
+there. Terms that were unavailable are not stored and are tried again by
+the next run.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+
+from fetch import chunks, RateLimiter, FOUND, MISSING, AMBIGUOUS, UNAVAILABLE
+from termlio import app, db, providers, cached_definitions, fetch_definitions, normalize_term, store_definitions, SetTerm
+import settings
+
+
+def read_terms(paths, include_sets):
+    for path in paths:
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                yield line.strip()
+    if include_sets:
+        for term, in db.session.query(SetTerm.term).order_by(SetTerm.id).yield_per(10000):
+            yield (term or '').strip()
+
+
+def unique_terms(terms):
+    # First spelling of every normalized term, in input order.
+    seen = set()
+    unique = []
+    for term in terms:
+        key = normalize_term(term)
+        if key and key not in seen:
+            seen.add(key)
+            unique.append(term)
+    return unique
+
+
+def load_progress(path, total):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            progress = json.load(f)
+        if progress['total'] == total:
+            return progress
+        print('%s is for a different term list; starting over.' % path)
+    counts = dict((name, 0) for name in ('hits', FOUND, MISSING, AMBIGUOUS, UNAVAILABLE))
+    return {'total': total, 'done': 0, 'counts': counts}
+
+
+def save_progress(path, progress):
+    if path:
+        partial = path + '.part'
+        with open(partial, 'w') as f:
+            json.dump(progress, f)
+        os.rename(partial, path)
+
+
+def limit_rate(rps):
+    # Every remote provider's client shares one budget of rps requests.
+    # Waiting on it counts against the fetch timeout, and a batch may
+    # need a search for each of its terms on top of a few other calls.
+    limiter = RateLimiter(rps)
+    for provider in providers:
+        if provider.remote:
+            provider.client.limiter = limiter
+    calls = settings.fetch['workers'] * (settings.wikipedia['batch_size'] + 3)
+    settings.fetch['timeout'] += calls / float(rps)
+
+
+def warm(terms, progress_path=None):
+    progress = load_progress(progress_path, len(terms))
+    counts = progress['counts']
+    group_size = settings.wikipedia['batch_size'] * settings.fetch['workers']
+    for group in chunks(terms[progress['done']:], group_size):
+        cached = cached_definitions(group)
+        stale = dict((key, definition) for key, definition in cached.items() if definition.is_expired())
+        misses = [term for term in group
+                  if normalize_term(term) not in cached or normalize_term(term) in stale]
+        counts['hits'] += len(group) - len(misses)
+        results = fetch_definitions(misses)
+        store_definitions(dict(zip(misses, results)), stale)
+        for status, value in results:
+            counts[status] += 1
+        progress['done'] += len(group)
+        save_progress(progress_path, progress)
+        sys.stderr.write('\r%d/%d terms' % (progress['done'], progress['total']))
+    sys.stderr.write('\n')
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prefetch definitions for term lists.')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--sets', action='store_true', help='also warm the terms of every saved set')
+    parser.add_argument('--rps', type=float, default=5, help='requests sent to Wikipedia per second')
+    parser.add_argument('--progress', help='file to save progress in, for resuming')
+    args = parser.parse_args()
+    if not args.files and not args.sets:
+        parser.error('give term files, --sets, or both')
+    if args.rps <= 0:
+        parser.error('--rps must be positive')
+
+    with app.app_context():
+        terms = unique_terms(read_terms(args.files, args.sets))
+        limit_rate(args.rps)
+        counts = warm(terms, args.progress)
+    print('%d terms: %d already cached, %d fetched, %d ambiguous, %d missing, %d unavailable' % (
+        len(terms), counts['hits'], counts[FOUND], counts[AMBIGUOUS], counts[MISSING], counts[UNAVAILABLE]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Background worker that defines large sets queued by /create.
+
+Run one or more next to the web server:
+
+    python worker.py
+
+Jobs and their per-term progress live in the database, so work that was
+queued or half done when a worker or web process restarted is picked up
+again.
+"""
+import time
+import traceback
+
+from termlio import app, db, metrics, claim_job, run_job
+import settings
+
+
+def work():
+    with app.app_context():
+        while True:
+            job = claim_job()
+            if job is None:
+                db.session.remove()
+                time.sleep(settings.jobs['poll_interval'])
+                continue
+            try:
+                run_job(job)
+            except Exception:
+                traceback.print_exc()
+                db.session.rollback()
+                # Let this or another worker retry it straight away.
+                job.status = 'pending'
+                db.session.commit()
+            db.session.remove()
+            metrics.maybe_flush()
+
+
+if __name__ == '__main__':
+    work()